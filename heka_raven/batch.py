@@ -0,0 +1,237 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Coalescing of many encoded sentry events into a single heka message.
+
+A batch is sent as a heka message of type 'sentry_batch'.  Its payload
+is a JSON document::
+
+    {"version": 1,
+     "events": [{"payload": "<encoded sentry event>",
+                 "logger": "myapp",
+                 "severity": 3,
+                 "timestamp": 1385729541.123,
+                 "fields": {"msg": "...", ...}},
+                ...]}
+
+Each event's "payload" is exactly what would have been sent as the
+payload of an individual 'sentry' message, so it can be decoded with
+`heka_raven.encoding.decode`.  The heka message itself carries a
+`count` field with the number of events in the batch, the highest
+severity (lowest number) of its events, the `dsn` field of its events
+and the fields the batcher was configured with.
+"""
+
+import functools
+import json
+import threading
+import time
+
+BATCH_TYPE = 'sentry_batch'
+ENVELOPE_VERSION = 1
+
+
+# Default `max_bytes` of a batch.  hekad rejects messages larger than
+# 64 KiB and a UDP datagram cannot exceed 65535 bytes, this leaves room
+# for the heka header, the message fields and the framing.
+MAX_BYTES = 49152
+
+
+def _encode_event(event):
+    return json.dumps(event, separators=(',', ':'))
+
+
+def _join_events(encoded):
+    return '{"version":%d,"events":[%s]}' % (ENVELOPE_VERSION,
+                                              ','.join(encoded))
+
+
+# Size of the payload of a batch without any event.
+_EMPTY_SIZE = len(_join_events([]))
+
+
+def encode_batch(events):
+    """
+    Build the payload of a 'sentry_batch' message from a list of event
+    dicts.
+    """
+    return _join_events([_encode_event(e) for e in events])
+
+
+def decode_batch(payload):
+    """
+    Return the list of events held by the payload of a 'sentry_batch'
+    message.  Each event is a dict with 'payload', 'logger',
+    'severity', 'timestamp' and 'fields' keys.
+    """
+    envelope = json.loads(payload)
+    version = envelope.get('version')
+    if version != ENVELOPE_VERSION:
+        raise ValueError("Unsupported batch version: %r" % (version,))
+    return envelope['events']
+
+
+class _Batch(object):
+    __slots__ = ('events', 'size', 'client', 'timer')
+
+    def __init__(self):
+        self.events = []
+        self.size = _EMPTY_SIZE
+        self.client = None
+        self.timer = None
+
+
+class Batcher(object):
+    """
+    Accumulates encoded sentry events and sends them as a single
+    'sentry_batch' heka message once `max_events` events or
+    `max_bytes` bytes of payload have been collected, or `max_latency`
+    seconds after the first event of the batch arrived, whichever
+    comes first.
+
+    Events routed to different DSNs are never mixed: there is one
+    batch per DSN, and the `dsn` field of a batch message is the DSN
+    of all of its events.
+
+    A batch is sent before an event which would make its payload
+    larger than `max_bytes` is added to it, so batches never exceed
+    `max_bytes` unless they hold a single event which is too large on
+    its own.
+
+    :param max_events: maximum number of events per batch
+    :param max_bytes: maximum size of a batch's payload
+    :param max_latency: maximum number of seconds an event waits in a
+                        batch
+    :param fields: fields added to every batch message
+    :param send: optional function called as `send(client, type=...,
+                 logger=..., payload=..., fields=..., severity=...)`
+                 to send a batch instead of `client.heka`
+    """
+
+    def __init__(self, max_events=100, max_bytes=MAX_BYTES, max_latency=1.0,
+                 fields=None, send=None):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.fields = fields or {}
+        self.send = send
+        self.after_fork()
+
+    def after_fork(self):
+        """
+        Forget the batches inherited from the parent process, which
+        still sends them.
+        """
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def add(self, client, payload, logger, severity, fields, dsn=None):
+        """
+        Add an encoded event to the current batch of `dsn`, sending the
+        batch through `client` if it is full.
+
+        :param dsn: DSN the event is routed to, sent in the `dsn` field
+                    of the batch message instead of the one in
+                    `fields`
+        """
+        event = {'payload': payload,
+                 'logger': logger,
+                 'severity': severity,
+                 'timestamp': time.time(),
+                 'fields': fields}
+
+        encoded = _encode_event(event)
+        # Count a separating comma for every event, including the first.
+        size = len(encoded) + 1
+
+        previous = None
+        full = False
+        self._lock.acquire()
+        try:
+            batch = self._batches.get(dsn)
+            if batch is not None and batch.size + size > self.max_bytes:
+                previous = self._take(dsn)
+                batch = None
+            if batch is None:
+                batch = self._batches[dsn] = _Batch()
+            batch.client = client
+            batch.events.append((encoded, logger, severity))
+            batch.size += size
+            if (len(batch.events) >= self.max_events or
+                    batch.size >= self.max_bytes):
+                full = True
+            elif batch.timer is None and self.max_latency:
+                batch.timer = threading.Timer(self.max_latency,
+                                              self._flush, (dsn,))
+                batch.timer.daemon = True
+                batch.timer.start()
+        finally:
+            self._lock.release()
+
+        if previous is not None:
+            self._send(*previous)
+        if full:
+            self._flush(dsn)
+
+    def _take(self, dsn):
+        # Must be called with the lock held.
+        batch = self._batches.pop(dsn, None)
+        if batch is None:
+            return [], None, None, dsn
+        return batch.events, batch.client, batch.timer, dsn
+
+    def _flush(self, dsn):
+        self._lock.acquire()
+        try:
+            batch = self._take(dsn)
+        finally:
+            self._lock.release()
+        return self._send(*batch)
+
+    def flush(self):
+        """
+        Send the current batches, if any.  Returns the number of events
+        sent.
+        """
+        self._lock.acquire()
+        try:
+            batches = [self._take(dsn) for dsn in list(self._batches)]
+        finally:
+            self._lock.release()
+        return sum(self._send(*batch) for batch in batches)
+
+    def _send(self, events, client, timer, dsn):
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+
+        if not events:
+            return 0
+
+        loggers = set(e[1] for e in events)
+        if len(loggers) == 1:
+            logger = loggers.pop()
+        else:
+            logger = None
+
+        severities = [e[2] for e in events if e[2] is not None]
+        severity = min(severities) if severities else None
+
+        fields = dict(self.fields)
+        if dsn is not None:
+            fields['dsn'] = dsn
+        fields['count'] = len(events)
+        if self.send is not None:
+            send = functools.partial(self.send, client)
+        else:
+            send = client.heka
+        send(type=BATCH_TYPE,
+             logger=logger,
+             payload=_join_events([e[0] for e in events]),
+             fields=fields,
+             severity=severity)
+        return len(events)
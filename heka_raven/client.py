@@ -0,0 +1,278 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+The raven client used by the heka plugin.
+
+Importing this module imports raven, `heka_raven.raven_plugin` only
+does so when the first exception is captured.
+"""
+
+from raven import Client
+from raven import events
+from raven.processors import SanitizePasswordsProcessor
+from raven.utils.stacks import iter_stack_frames
+
+import datetime
+import logging
+import uuid
+
+from heka_raven.encoding import RAVEN
+from heka_raven.frames import CACHE_SIZE
+from heka_raven.protocol import V3
+from heka_raven.protocol import BaseEventBuilder
+from heka_raven.protocol import _annotate
+from heka_raven.protocol import get_culprit
+from heka_raven.protocol import to_text
+from heka_raven.serializer import MAX_DEPTH
+from heka_raven.serializer import VarsSerializer
+
+
+class ExceptionEvent(events.Exception):
+    """
+    Raven exception event which serializes the stack through
+    `RavenClient.get_stack_info` so that the client's limits on frames
+    and variables are enforced.
+
+    The exceptions the captured one was raised from or while handling
+    are added to the event as an 'exception_chain' list, see
+    `heka_raven.protocol.BaseEventBuilder._exception_data`.
+    """
+
+    def capture(self, exc_info=None, annotations=None, chain=None,
+                **kwargs):
+        return self.client._exception_data(
+            exc_info, annotations, chain, kwargs.get('level', logging.ERROR))
+
+
+class RavenClient(BaseEventBuilder, Client):
+    """
+    Customized raven client that does not actually send data to a
+    server, but encodes the data into something heka can use
+
+    In addition to the options understood by raven's `Client`, the
+    amount of work done serializing a stack can be bounded with:
+
+    :param max_frames: maximum number of frames captured.  When a stack
+                       is deeper than this, frames are dropped from the
+                       middle of the stack.
+    :param max_locals: maximum number of variables captured per frame
+    :param max_depth: maximum nesting of captured containers
+    :param include_vars: if given, only variables with these names are
+                         captured
+    :param exclude_vars: variables with these names are never captured
+    :param encoding: how events are encoded, one of 'raven' (the
+                     default), 'fast', 'json', 'stream' or 'envelope'.
+                     See `heka_raven.encoding`.
+    :param stats: optional `heka_raven.stats.Stats` recording how long
+                  building and encoding events takes and how large
+                  they are
+    :param max_payload_size: maximum size of an encoded event.  Larger
+                             events are trimmed until they fit, see
+                             `fit`.
+    :param frame_cache_size: number of source snippets and code objects
+                             whose serialized details are cached, 0
+                             disables the caches.  See
+                             `heka_raven.frames`.
+    :param scrubber: optional `heka_raven.scrub.Scrubber` masking
+                     secrets in frame variables, extra data, exception
+                     values and messages while the event is built.  It
+                     replaces raven's `SanitizePasswordsProcessor`.
+    :param protocol: 'v3' (the default) or 'v4', the layout of the
+                     encoded events.  See `heka_raven.protocol`.
+
+    The `string_max_length` and `list_max_length` raven options bound
+    the length of captured strings and containers.
+    """
+    exception_event = 'heka_raven.client.ExceptionEvent'
+
+    def __init__(self, dsn=None, max_frames=None, max_locals=None,
+                 max_depth=MAX_DEPTH, include_vars=None, exclude_vars=None,
+                 encoding=RAVEN, stats=None, max_payload_size=None,
+                 frame_cache_size=CACHE_SIZE, scrubber=None, protocol=V3,
+                 **options):
+        Client.__init__(self, dsn, **options)
+        self._configure(max_frames=max_frames, max_locals=max_locals,
+                        max_depth=max_depth, include_vars=include_vars,
+                        exclude_vars=exclude_vars, encoding=encoding,
+                        stats=stats, max_payload_size=max_payload_size,
+                        frame_cache_size=frame_cache_size,
+                        scrubber=scrubber, protocol=protocol)
+        self._handlers = {}
+
+    def refresh_static_data(self):
+        """
+        (Re)compute the parts of every event which do not change for
+        the life of the process: installed module versions, server
+        name, site, project, the serialized client context and the
+        processor instances.  This is done once, on the first capture,
+        unless called explicitly.
+        """
+        extra = {}
+        for k, v in (self.extra or {}).items():
+            extra[k] = self.transform(v)
+
+        processors = list(Client.get_processors(self))
+        if self.scrubber is not None:
+            # The scrubber already masked everything it would.
+            processors = [p for p in processors
+                          if not isinstance(p, SanitizePasswordsProcessor)]
+
+        return self._set_static_data({
+            'server_name': self.name,
+            'modules': self.get_module_versions(),
+            'project': self.project,
+            'site': self.site,
+            'extra': extra,
+            'processors': processors,
+        })
+
+    def get_processors(self):
+        return iter(self.get_static_data()['processors'])
+
+    def get_handler(self, name):
+        handler = self._handlers.get(name)
+        if handler is None:
+            handler = self._handlers[name] = Client.get_handler(self, name)
+        return handler
+
+    def build_msg(self, event_type, data=None, date=None,
+                  time_spent=None, extra=None, stack=None, public_key=None,
+                  tags=None, **kwargs):
+        """
+        Captures, processes and serializes an event into a dict object.
+
+        This follows raven's `Client.build_msg`, except that the static
+        envelope from `get_static_data` is merged in rather than being
+        recomputed for every event, and stacks are serialized through
+        `get_stack_info`.
+        """
+        static_data = self.get_static_data()
+
+        # create ID client-side so that it can be passed to application
+        event_id = uuid.uuid4().hex
+
+        if data is None:
+            data = {}
+        if extra is None:
+            extra = {}
+        if not date:
+            date = datetime.datetime.utcnow()
+        if stack is None:
+            stack = self.auto_log_stacks
+
+        if '.' not in event_type:
+            # Assume it's a builtin
+            event_type = 'raven.events.%s' % event_type
+
+        handler = self.get_handler(event_type)
+        result = handler.capture(**kwargs)
+
+        # data (explicit) culprit takes over auto event detection
+        culprit = result.pop('culprit', None)
+        if data.get('culprit'):
+            culprit = data['culprit']
+
+        for k, v in result.items():
+            if k not in data:
+                data[k] = v
+
+        scrubber = self.scrubber
+        if scrubber is not None:
+            self._scrub_text(data, kwargs.get('annotations'))
+
+        if stack and 'sentry.interfaces.Stacktrace' not in data:
+            if stack is True:
+                frames = iter_stack_frames()
+            else:
+                frames = stack
+            data['sentry.interfaces.Stacktrace'] = {
+                'frames': self.get_stack_info(frames,
+                                              kwargs.get('annotations')),
+            }
+
+        if 'sentry.interfaces.Stacktrace' in data:
+            frames = data['sentry.interfaces.Stacktrace']['frames']
+            self._mark_in_app(frames)
+            if not culprit:
+                culprit = get_culprit(frames)
+
+        if not data.get('level'):
+            data['level'] = kwargs.get('level') or logging.ERROR
+
+        if not data.get('server_name'):
+            data['server_name'] = static_data['server_name']
+
+        if not data.get('modules'):
+            data['modules'] = static_data['modules']
+
+        data['tags'] = tags or {}
+
+        # Only the per event extra data needs serializing, the client
+        # context was serialized once in the static envelope.
+        event_extra = data.setdefault('extra', {})
+        for k, v in extra.items():
+            event_extra[k] = v
+        if scrubber is None:
+            for k, v in event_extra.items():
+                event_extra[k] = self.transform(v)
+        else:
+            serializer = VarsSerializer(max_items=self.list_max_length,
+                                        max_repr_length=self.string_max_length,
+                                        max_depth=self.max_depth,
+                                        scrubber=scrubber)
+            for k, v in event_extra.items():
+                if scrubber.sensitive_key(k):
+                    serializer.values_scrubbed += 1
+                    event_extra[k] = scrubber.mask
+                else:
+                    event_extra[k] = serializer.transform(v)
+            _annotate(kwargs.get('annotations'), 'values_scrubbed',
+                      serializer.values_scrubbed)
+        for k, v in static_data['extra'].items():
+            event_extra.setdefault(k, v)
+
+        if culprit:
+            data['culprit'] = culprit
+
+        # Run the data through processors
+        for processor in static_data['processors']:
+            data.update(processor.process(data))
+
+        if 'message' not in data:
+            data['message'] = handler.to_string(data)
+
+        data.setdefault('project', static_data['project'])
+
+        # Legacy support for site attribute
+        site = data.pop('site', None) or static_data['site']
+        if site:
+            data['tags'].setdefault('site', site)
+
+        for key, value in data['tags'].items():
+            data['tags'][key] = to_text(value)
+
+        # It's important date is added **after** we serialize
+        data.update({
+            'timestamp': date,
+            'time_spent': time_spent,
+            'event_id': event_id,
+            'platform': 'python',
+        })
+
+        return data
+
+    def captureException(self, exc_info=None, **kwargs):
+        """
+        Creates an event from an exception.
+
+        :param annotations: optional dict which will be updated with
+                            counts of anything left out of the event to
+                            keep it within the configured limits
+        """
+        return self.capture(self.exception_event, exc_info=exc_info,
+                            **kwargs)
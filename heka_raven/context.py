@@ -0,0 +1,192 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Context attached to captured exceptions.
+
+Each thread, or each asyncio task on Python 3.7 and later, has its own
+`Context` holding the current user, request id, tags and a ring buffer
+of recent breadcrumbs.  Updating it is cheap: breadcrumbs are stored as
+tuples in a preallocated list and nothing is serialized until an
+exception is captured.
+
+Call `new_context` at the start of every request (or task), then::
+
+    from heka_raven import context
+
+    context.new_context(request_id=request.id)
+    context.set_user(id=user.id, username=user.name)
+    context.set_tag('endpoint', 'checkout')
+    context.add_breadcrumb('cart loaded', category='db')
+"""
+
+import threading
+import time
+
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
+
+MAX_BREADCRUMBS = 20
+
+
+class Context(object):
+    """
+    User, request id, tags and recent breadcrumbs of the current
+    request.
+
+    :param max_breadcrumbs: number of breadcrumbs kept, older ones are
+                            overwritten
+    """
+
+    def __init__(self, request_id=None, max_breadcrumbs=MAX_BREADCRUMBS):
+        self.request_id = request_id
+        self.user = None
+        self.tags = {}
+        self._crumbs = [None] * max_breadcrumbs
+        self._next = 0
+
+    def add_breadcrumb(self, message, category=None, level='info',
+                       data=None):
+        """
+        Record a breadcrumb, overwriting the oldest one if the buffer
+        is full.
+        """
+        size = len(self._crumbs)
+        if size:
+            self._crumbs[self._next % size] = (time.time(), category,
+                                               message, level, data)
+            self._next += 1
+
+    def breadcrumbs(self):
+        """
+        Return the breadcrumbs kept, oldest first, as dicts.
+        """
+        size = len(self._crumbs)
+        start = max(0, self._next - size)
+        crumbs = []
+        for i in range(start, self._next):
+            timestamp, category, message, level, data = \
+                self._crumbs[i % size]
+            crumb = {'timestamp': timestamp, 'message': message,
+                     'level': level}
+            if category is not None:
+                crumb['category'] = category
+            if data is not None:
+                crumb['data'] = data
+            crumbs.append(crumb)
+        return crumbs
+
+    def snapshot(self):
+        """
+        Return the context as plain data, to attach to an event.
+        """
+        return {'request_id': self.request_id,
+                'user': self.user and dict(self.user),
+                'tags': dict(self.tags),
+                'breadcrumbs': self.breadcrumbs()}
+
+
+if contextvars is not None:
+    _current = contextvars.ContextVar('heka_raven_context', default=None)
+
+    def get_current():
+        """
+        Return the `Context` of the current task or thread, or None.
+        """
+        return _current.get()
+
+    def _set_current(ctx):
+        _current.set(ctx)
+else:
+    _local = threading.local()
+
+    def get_current():
+        """
+        Return the `Context` of the current thread, or None.
+        """
+        return getattr(_local, 'context', None)
+
+    def _set_current(ctx):
+        _local.context = ctx
+
+
+def new_context(request_id=None, max_breadcrumbs=MAX_BREADCRUMBS):
+    """
+    Start a new, empty, context for the current thread or task and
+    return it.
+    """
+    ctx = Context(request_id, max_breadcrumbs)
+    _set_current(ctx)
+    return ctx
+
+
+def get_context():
+    """
+    Return the `Context` of the current thread or task, starting a new
+    one if needed.
+    """
+    ctx = get_current()
+    if ctx is None:
+        ctx = new_context()
+    return ctx
+
+
+def clear_context():
+    """
+    Forget the context of the current thread or task.
+    """
+    _set_current(None)
+
+
+def set_user(**user):
+    """
+    Set the user of the current context, e.g. `set_user(id=42)`.
+    """
+    get_context().user = user
+
+
+def set_request_id(request_id):
+    """
+    Set the request id of the current context.
+    """
+    get_context().request_id = request_id
+
+
+def set_tag(key, value):
+    """
+    Set a tag of the current context.
+    """
+    get_context().tags[key] = value
+
+
+def add_breadcrumb(message, category=None, level='info', data=None):
+    """
+    Record a breadcrumb in the current context.
+    """
+    get_context().add_breadcrumb(message, category, level, data)
+
+
+def capture_options(snapshot, extra):
+    """
+    Return the keyword arguments for `RavenClient.capture` which attach
+    a context `snapshot` to an event with the `extra` data: the user
+    becomes the sentry User interface, the request id a tag and the
+    breadcrumbs an extra value.
+    """
+    options = {'extra': extra}
+    if snapshot['user']:
+        options['data'] = {'sentry.interfaces.User': snapshot['user']}
+    tags = snapshot['tags']
+    if snapshot['request_id'] is not None:
+        tags['request_id'] = snapshot['request_id']
+    if tags:
+        options['tags'] = tags
+    if snapshot['breadcrumbs']:
+        extra['breadcrumbs'] = snapshot['breadcrumbs']
+    return options
@@ -0,0 +1,222 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Exception fingerprinting and per-fingerprint rate limiting.
+
+A fingerprint is computed by walking the raw traceback only - no
+source lines are read and no local variables are touched - so it is
+cheap enough to compute for every exception before raven's
+`build_msg` is ever invoked.
+"""
+
+import threading
+import time
+
+# Return values of `Deduplicator.check` other than a positive count
+CAPTURE = -1
+SUPPRESS = 0
+
+
+def fingerprint(exc_info):
+    """
+    Compute a hashable fingerprint for an exception.
+
+    The fingerprint is a tuple of the exception type name, the culprit
+    (in raven's "module in function" format) and the filename/line
+    number of every frame in the traceback.
+
+    :param exc_info: a (type, value, traceback) tuple as returned by
+                     `sys.exc_info()`
+    """
+    exc_type, exc_value, tb = exc_info
+    type_name = getattr(exc_type, '__name__', '<unknown>')
+
+    frames = []
+    culprit = ''
+    while tb is not None:
+        frame = tb.tb_frame
+        code = frame.f_code
+        frames.append((code.co_filename, tb.tb_lineno))
+        if tb.tb_next is None:
+            module = frame.f_globals.get('__name__') or '?'
+            culprit = '%s in %s' % (module, code.co_name)
+        tb = tb.tb_next
+
+    return (type_name, culprit, tuple(frames))
+
+
+def fingerprint_id(fp):
+    """
+    Render a fingerprint as a short, stable hex string suitable for
+    use in heka message fields.
+    """
+    import hashlib
+    return hashlib.md5(repr(fp).encode('utf8')).hexdigest()
+
+
+class _Entry(object):
+    __slots__ = ('tokens', 'last_seen', 'suppressed', 'window_start')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.last_seen = now
+        self.suppressed = 0
+        self.window_start = now
+
+
+class Deduplicator(object):
+    """
+    Collapse repeated exceptions using a token bucket per fingerprint.
+
+    Each fingerprint may be fully captured `burst` times in a row,
+    after which it is refilled at `rate` captures per second.
+    Exceptions which arrive while the bucket is empty are counted
+    instead of captured.  The count is handed back by `check` when the
+    same fingerprint shows up again after `window` seconds, and, when
+    `send` is given, passed to `send(fingerprint, count)` every
+    `window` seconds from a timer and before its fingerprint is
+    forgotten, so that a single "seen N times" message can be sent in
+    place of the suppressed events.
+
+    :param window: number of seconds between summaries of suppressed
+                   repeats
+    :param rate: number of full captures per second a fingerprint is
+                 refilled with.  Defaults to one per `window`.
+    :param burst: maximum number of back to back full captures of a
+                  fingerprint
+    :param max_entries: upper bound on the number of fingerprints
+                        tracked at once
+    :param send: optional function called with each fingerprint and
+                 its count of suppressed occurrences
+    """
+
+    def __init__(self, window, rate=None, burst=1, max_entries=1000,
+                 send=None, clock=time.time):
+        if window <= 0:
+            raise ValueError("window must be positive")
+        if rate is None:
+            rate = 1.0 / window
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self.send = send
+        self.clock = clock
+        self.after_fork()
+
+    def after_fork(self):
+        """
+        Start from scratch in a child process, so that repeats
+        suppressed in the parent are not summarized twice.
+        """
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def check(self, fp):
+        """
+        Record an occurrence of `fp`.
+
+        Returns `CAPTURE` if the exception should be fully captured,
+        `SUPPRESS` if it should be dropped, or a positive number of
+        suppressed occurrences (including this one) which should be
+        reported as a summary.
+        """
+        now = self.clock()
+        evicted = None
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(fp)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    evicted = self._prune(now)
+                entry = self._entries[fp] = _Entry(self.burst, now)
+            else:
+                entry.tokens = min(self.burst, entry.tokens +
+                                   (now - entry.last_seen) * self.rate)
+                entry.last_seen = now
+
+            if entry.tokens >= 1:
+                entry.tokens -= 1
+                return CAPTURE
+
+            if entry.suppressed == 0:
+                entry.window_start = now
+            entry.suppressed += 1
+
+            if now - entry.window_start >= self.window:
+                count = entry.suppressed
+                entry.suppressed = 0
+                return count
+            if self.send is not None and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return SUPPRESS
+        finally:
+            self._lock.release()
+            if evicted:
+                for item in evicted:
+                    self.send(*item)
+
+    def drain(self):
+        """
+        Return a list of (fingerprint, count) pairs for every
+        fingerprint with suppressed occurrences that have not been
+        summarized yet, and reset those counts.
+        """
+        self._lock.acquire()
+        try:
+            pending = []
+            for fp, entry in self._entries.items():
+                if entry.suppressed:
+                    pending.append((fp, entry.suppressed))
+                    entry.suppressed = 0
+            return pending
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        Pass every pending count to `send`.  Called every `window`
+        seconds while occurrences are suppressed.  Returns the number
+        of counts sent.
+        """
+        self._lock.acquire()
+        try:
+            timer, self._timer = self._timer, None
+        finally:
+            self._lock.release()
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+
+        pending = self.drain()
+        if self.send is not None:
+            for fp, count in pending:
+                self.send(fp, count)
+        return len(pending)
+
+    def _prune(self, now):
+        # Forget idle fingerprints first.  If everything is still
+        # active, forget the least recently seen half so that memory
+        # stays bounded during a storm of distinct exceptions.  Returns
+        # the pending counts of forgotten fingerprints, to be sent
+        # once the lock is released.
+        for fp, entry in list(self._entries.items()):
+            if not entry.suppressed and now - entry.last_seen > self.window:
+                del self._entries[fp]
+
+        evicted = []
+        if len(self._entries) >= self.max_entries:
+            by_age = sorted(self._entries.items(),
+                            key=lambda item: item[1].last_seen)
+            for fp, entry in by_age[:len(by_age) // 2 or 1]:
+                if entry.suppressed and self.send is not None:
+                    evicted.append((fp, entry.suppressed))
+                del self._entries[fp]
+        return evicted
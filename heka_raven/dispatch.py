@@ -0,0 +1,285 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Background capture of exceptions.
+
+The request thread only takes a snapshot of the traceback (code
+objects, line numbers and a shallow copy of each frame's locals) and
+hands it to a pool of worker threads which do the expensive raven
+serialization, encoding and the send to heka.
+"""
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+import logging
+import threading
+import time
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_BLOCK = 'block'
+
+# Maximum number of chained exceptions captured with an exception.
+MAX_CHAIN = 5
+
+log = logging.getLogger('heka_raven')
+
+
+class _FrameSnapshot(object):
+    """
+    Stand in for a frame object holding only the attributes raven
+    looks at when serializing a stack.
+    """
+    __slots__ = ('f_code', 'f_globals', 'f_locals', 'f_lineno')
+
+    def __init__(self, frame, lineno):
+        self.f_code = frame.f_code
+        f_globals = frame.f_globals
+        self.f_globals = {'__name__': f_globals.get('__name__'),
+                          '__loader__': f_globals.get('__loader__')}
+        try:
+            self.f_locals = dict(frame.f_locals)
+        except Exception:
+            self.f_locals = {}
+        self.f_lineno = lineno
+
+
+class _TracebackSnapshot(object):
+    """
+    Stand in for a traceback object which references frame snapshots
+    instead of live frames.
+    """
+    __slots__ = ('tb_frame', 'tb_lineno', 'tb_next')
+
+    def __init__(self, frame, lineno):
+        self.tb_frame = frame
+        self.tb_lineno = lineno
+        self.tb_next = None
+
+
+def snapshot_exc_info(exc_info, memo=None):
+    """
+    Copy the minimal amount of data raven needs out of `exc_info` so
+    that it can be serialized later, on another thread, without
+    keeping the live frames (and everything they reference) alive.
+
+    Locals are copied shallowly: rebinding a name after the snapshot is
+    taken is not visible to the capture, mutating a referenced object
+    is.
+
+    :param memo: optional dict used to snapshot a frame found in
+                 several tracebacks only once
+    """
+    exc_type, exc_value, tb = exc_info
+    head = tail = None
+    while tb is not None:
+        lineno = tb.tb_lineno
+        frame = tb.tb_frame
+        if memo is None:
+            frame_snapshot = _FrameSnapshot(frame, lineno)
+        else:
+            frame_snapshot = memo.get(frame)
+            if frame_snapshot is None:
+                frame_snapshot = memo[frame] = _FrameSnapshot(frame, lineno)
+        node = _TracebackSnapshot(frame_snapshot, lineno)
+        if head is None:
+            head = node
+        else:
+            tail.tb_next = node
+        tail = node
+        tb = tb.tb_next
+    return (exc_type, exc_value, head)
+
+
+def exception_chain(exc_value, limit=MAX_CHAIN):
+    """
+    Return the exceptions `exc_value` was raised from (its `__cause__`)
+    or while handling (its `__context__`), and theirs in turn, as a
+    list of (relation, exc_info) pairs where relation is 'cause' or
+    'context'.  The list is empty on Python 2, unless these attributes
+    were set explicitly.
+    """
+    chain = []
+    seen = set([id(exc_value)])
+    while len(chain) < limit:
+        cause = getattr(exc_value, '__cause__', None)
+        relation = 'cause'
+        if cause is None and not getattr(exc_value, '__suppress_context__',
+                                         False):
+            cause = getattr(exc_value, '__context__', None)
+            relation = 'context'
+        if cause is None or id(cause) in seen:
+            break
+        seen.add(id(cause))
+        chain.append((relation, (type(cause), cause,
+                                 getattr(cause, '__traceback__', None))))
+        exc_value = cause
+    return chain
+
+
+def snapshot_chain(exc_info, limit=MAX_CHAIN):
+    """
+    Snapshot `exc_info` and the exceptions chained to it, see
+    `snapshot_exc_info`.  Returns the snapshot of `exc_info` and the
+    list of (relation, exc_info snapshot) pairs of the chain.  Frames
+    found in several tracebacks are only copied once.
+    """
+    memo = {}
+    chain = [(relation, snapshot_exc_info(cause, memo))
+             for relation, cause in exception_chain(exc_info[1], limit)]
+    return snapshot_exc_info(exc_info, memo), chain
+
+
+class ThreadDispatcher(object):
+    """
+    Run capture jobs on a pool of daemon worker threads fed from a
+    bounded queue.
+
+    :param queue_size: maximum number of jobs waiting for a worker
+    :param workers: number of worker threads
+    :param overflow: what to do when the queue is full.  'drop'
+                     discards the new job, 'block' waits for room.
+    :param block_timeout: when `overflow` is 'block', the maximum number
+                          of seconds to wait before dropping the job.
+                          None waits forever.
+    """
+
+    def __init__(self, queue_size=1000, workers=1, overflow=OVERFLOW_DROP,
+                 block_timeout=None):
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_BLOCK):
+            raise ValueError("Unknown overflow policy: %r" % overflow)
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+        self.queue_size = queue_size
+        self.workers = workers
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.counters = {'queued': 0, 'dropped': 0, 'sent': 0, 'failed': 0}
+
+        self._queue = queue.Queue(queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _incr(self, name):
+        self._lock.acquire()
+        try:
+            self.counters[name] += 1
+        finally:
+            self._lock.release()
+
+    def after_fork(self):
+        """
+        Forget the state inherited from the parent process: its worker
+        threads do not exist in the child and its queued jobs are
+        still processed by the parent.
+        """
+        self.counters = dict.fromkeys(self.counters, 0)
+        self._queue = queue.Queue(self.queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run,
+                                     name='heka_raven-worker-%d' % i)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                try:
+                    fn(*args)
+                except Exception:
+                    self._incr('failed')
+                    log.exception("Error capturing exception in background")
+                else:
+                    self._incr('sent')
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn, *args):
+        """
+        Queue `fn(*args)` to be run on a worker thread.  Returns False
+        if the job was dropped because the queue is full.
+        """
+        if not self._threads:
+            self._start()
+
+        try:
+            if self.overflow == OVERFLOW_BLOCK:
+                self._queue.put((fn, args), True, self.block_timeout)
+            else:
+                self._queue.put_nowait((fn, args))
+        except queue.Full:
+            self._incr('dropped')
+            return False
+        self._incr('queued')
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued job has been processed.  Returns False
+        if `timeout` seconds elapsed first.
+        """
+        q = self._queue
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        q.all_tasks_done.acquire()
+        try:
+            while q.unfinished_tasks:
+                if deadline is None:
+                    q.all_tasks_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    q.all_tasks_done.wait(remaining)
+            return True
+        finally:
+            q.all_tasks_done.release()
+
+    def close(self, timeout=None):
+        """
+        Flush pending jobs and stop the worker threads.
+        """
+        flushed = self.flush(timeout)
+        self._lock.acquire()
+        try:
+            threads, self._threads = self._threads, []
+        finally:
+            self._lock.release()
+        for t in threads:
+            self._queue.put(None)
+        for t in threads:
+            t.join(timeout)
+        return flushed
+
+    def stats(self):
+        """
+        Return a copy of the queued/dropped/sent/failed counters.
+        """
+        self._lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self._lock.release()
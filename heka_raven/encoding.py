@@ -0,0 +1,309 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Encodings for the sentry payload carried in heka messages.
+
+raven
+    raven's own encoding: stdlib JSON, zlib compressed and base64
+    encoded.  This is what Sentry bound hekad outputs expect.
+fast
+    The same wire format as `raven`, but serialized with the fastest
+    JSON library available (orjson, ujson or simplejson, falling back
+    to the stdlib).
+json
+    Plain JSON text serialized with the fastest JSON library available.
+    No compression and no base64, for local hops to hekad where
+    compressing is wasted CPU.
+stream
+    The same wire format as `raven`, but the JSON text is produced
+    incrementally and fed to the compressor in chunks, so that the
+    whole uncompressed event is never held in memory.  About 5 times
+    slower than `raven`, it is never picked by default.
+envelope
+    A Sentry envelope in plain text: a header line with the event id
+    and the time it was sent, an item header line with the item type
+    and length, then the event as JSON.  Only meaningful for events in
+    the v4 layout, see `heka_raven.protocol`.
+
+None of them import raven: the `raven` and `stream` encodings use
+`EventJSONEncoder`, which serializes events the way raven's own JSON
+encoder does.
+
+`decode` understands all of the above without being told which one
+was used.
+"""
+
+import base64
+import datetime
+import json as stdlib_json
+import uuid
+import zlib
+
+RAVEN = 'raven'
+FAST = 'fast'
+JSON = 'json'
+STREAM = 'stream'
+ENVELOPE = 'envelope'
+
+# Amount of JSON text the `stream` encoding buffers before compressing
+# it.
+STREAM_CHUNK_SIZE = 16384
+
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _stdlib_dumps(value):
+    return stdlib_json.dumps(value, separators=(',', ':'))
+
+
+def _find_dumps():
+    """
+    Return the name of the fastest JSON library installed and a
+    `dumps` function for it which returns text.
+    """
+    try:
+        import orjson
+        return 'orjson', lambda value: orjson.dumps(value).decode('utf8')
+    except ImportError:
+        pass
+
+    try:
+        import ujson
+        return 'ujson', ujson.dumps
+    except ImportError:
+        pass
+
+    try:
+        import simplejson
+        return 'simplejson', lambda value: simplejson.dumps(
+            value, separators=(',', ':'))
+    except ImportError:
+        pass
+
+    return 'json', _stdlib_dumps
+
+json_library, fast_dumps = _find_dumps()
+
+
+def _prepare(data):
+    """
+    raven leaves the event timestamp as a datetime, and the faster
+    JSON libraries either reject datetimes or render them differently
+    from raven.  Format it the way raven would.
+    """
+    timestamp = data.get('timestamp')
+    if isinstance(timestamp, datetime.datetime):
+        data = dict(data)
+        data['timestamp'] = timestamp.strftime(_TIMESTAMP_FORMAT)
+    return data
+
+
+def _compress(text):
+    return base64.b64encode(zlib.compress(text.encode('utf8')))
+
+
+class EventJSONEncoder(stdlib_json.JSONEncoder):
+    """
+    JSON encoder rendering UUIDs, datetimes and sets the way raven's
+    `BetterJSONEncoder` does.
+    """
+
+    def default(self, value):
+        if isinstance(value, uuid.UUID):
+            return value.hex
+        if isinstance(value, datetime.datetime):
+            return value.strftime(_TIMESTAMP_FORMAT)
+        if isinstance(value, (set, frozenset)):
+            return list(value)
+        return stdlib_json.JSONEncoder.default(self, value)
+
+
+def _raven_dumps(data):
+    return stdlib_json.dumps(data, cls=EventJSONEncoder)
+
+
+def _fast_dumps(data):
+    data = _prepare(data)
+    try:
+        return fast_dumps(data)
+    except (TypeError, OverflowError, ValueError):
+        # ujson and orjson reject integers beyond 64 bits and orjson
+        # non-string dict keys, which the stdlib handles.
+        return stdlib_json.dumps(data, cls=EventJSONEncoder,
+                                 separators=(',', ':'))
+
+
+_stream_encoder = None
+
+
+def _get_stream_encoder():
+    global _stream_encoder
+    if _stream_encoder is None:
+        _stream_encoder = EventJSONEncoder()
+    return _stream_encoder
+
+
+def _envelope_dumps(data):
+    event = _fast_dumps(data)
+    header = _stdlib_dumps({
+        'event_id': data.get('event_id'),
+        'sent_at': datetime.datetime.utcnow().strftime(_TIMESTAMP_FORMAT),
+    })
+    item_header = _stdlib_dumps({'type': 'event',
+                                 'length': len(event.encode('utf8'))})
+    return '\n'.join((header, item_header, event))
+
+
+def _b64_feed(out, compressed):
+    # base64 encodes 3 bytes at a time, keep the remainder for later.
+    usable = len(compressed) - len(compressed) % 3
+    if usable:
+        out.append(base64.b64encode(compressed[:usable]))
+    return compressed[usable:]
+
+
+def encode_raven(data):
+    """
+    Encode `data` exactly as raven's `Client.encode` does.
+    """
+    return _compress(_raven_dumps(data))
+
+
+def encode_fast(data):
+    """
+    Encode `data` in raven's wire format using the fastest JSON
+    library available.
+    """
+    return _compress(_fast_dumps(data))
+
+
+def encode_json(data):
+    """
+    Encode `data` as plain JSON text.
+    """
+    return _fast_dumps(data)
+
+
+def encode_stream(data, sizes=None):
+    """
+    Encode `data` in the same wire format as `encode_raven`, without
+    holding its whole JSON text, or its UTF-8 and compressed copies, at
+    once.  The text is serialized incrementally, compressed
+    `STREAM_CHUNK_SIZE` characters at a time and base64 encoded as
+    compressed bytes come out.  If `sizes` is given, its 'raw_bytes'
+    key is set to the size of the JSON text.
+
+    This trades CPU for peak memory: the pure Python `iterencode` makes
+    it about 5 times slower than `encode_raven` on Python 2, so it is
+    only used when the `stream` encoding is configured explicitly.
+    """
+    compressor = zlib.compressobj()
+    out = []
+    pending = b''
+    raw_bytes = 0
+    chunks = []
+    buffered = 0
+    for chunk in _get_stream_encoder().iterencode(data):
+        chunks.append(chunk)
+        buffered += len(chunk)
+        if buffered >= STREAM_CHUNK_SIZE:
+            text = ''.join(chunks).encode('utf8')
+            raw_bytes += len(text)
+            pending = _b64_feed(out, pending + compressor.compress(text))
+            chunks = []
+            buffered = 0
+    text = ''.join(chunks).encode('utf8')
+    raw_bytes += len(text)
+    pending += compressor.compress(text) + compressor.flush()
+    out.append(base64.b64encode(pending))
+    if sizes is not None:
+        sizes['raw_bytes'] = raw_bytes
+    return b''.join(out)
+
+
+def encode_envelope(data):
+    """
+    Encode `data` as a Sentry envelope holding a single event item.
+    """
+    return _envelope_dumps(data)
+
+
+ENCODERS = {
+    RAVEN: encode_raven,
+    FAST: encode_fast,
+    JSON: encode_json,
+    STREAM: encode_stream,
+    ENVELOPE: encode_envelope,
+}
+
+
+def get_encoder(name):
+    """
+    Look up the encode function for the encoding called `name`.
+    """
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError("Unknown encoding: %r" % (name,))
+
+
+STAGES = {
+    RAVEN: (_raven_dumps, _compress),
+    FAST: (_fast_dumps, _compress),
+    JSON: (_fast_dumps, None),
+    STREAM: (None, None),
+    ENVELOPE: (_envelope_dumps, None),
+}
+
+
+def get_stages(name):
+    """
+    Look up the two stages of the encoding called `name`: a function
+    serializing an event to JSON text and a function compressing that
+    text, or None if the encoding does not compress.  Both are None
+    for the `stream` encoding, which does both in a single pass.
+    """
+    try:
+        return STAGES[name]
+    except KeyError:
+        raise ValueError("Unknown encoding: %r" % (name,))
+
+
+def decode(payload):
+    """
+    Decode a sentry payload produced by any of the encodings.
+    """
+    if isinstance(payload, bytes) and not isinstance(payload, str):
+        payload = payload.decode('utf8')
+    payload = payload.strip()
+    if payload[:1] == '{':
+        header, sep, items = payload.partition('\n')
+        if sep:
+            return decode_envelope(items)
+        return stdlib_json.loads(payload)
+    return stdlib_json.loads(
+        zlib.decompress(base64.b64decode(payload)).decode('utf8'))
+
+
+def decode_envelope(items):
+    """
+    Return the first event held by the `items` of an envelope, the
+    lines following its header.
+    """
+    items = items.encode('utf8')
+    while items:
+        item_header, sep, items = items.partition(b'\n')
+        item_header = stdlib_json.loads(item_header.decode('utf8'))
+        length = item_header.get('length')
+        if length is None:
+            body, sep, items = items.partition(b'\n')
+        else:
+            body, items = items[:length], items[length + 1:]
+        if item_header.get('type') == 'event':
+            return stdlib_json.loads(body.decode('utf8'))
+    raise ValueError("No event found in envelope")
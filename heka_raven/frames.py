@@ -0,0 +1,231 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Caches used when serializing stack frames.
+
+The same few files show up in nearly every exception a process
+raises.  raven reads and decodes the whole source file for every frame
+of every event to pick the lines around it.  `SourceCache` keeps the
+decoded lines of recently used files and the context of recently used
+(filename, line number) pairs, and only rereads a file when its
+modification time changed.
+
+Both caches are `LRUCache` instances, which keep at most `maxsize`
+entries and forget the least recently used ones first.
+"""
+
+import os
+import re
+import threading
+
+# Default number of entries of the caches of `RavenClient`.
+CACHE_SIZE = 1000
+
+# Maximum number of files whose lines are kept by a `SourceCache`.
+MAX_FILES = 20
+
+_coding_re = re.compile(r'coding[:=]\s*([-\w.]+)')
+
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
+
+# Indexes into the links of `LRUCache`
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping holding at most `maxsize` entries.  When full,
+    the least recently read or written entry is evicted.  A `maxsize`
+    of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def after_fork(self):
+        """
+        Replace the lock inherited from the parent process, which may
+        have been held by another thread when it forked.  The entries
+        are still valid and are kept.
+        """
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Forget every entry.
+        """
+        self._lock.acquire()
+        try:
+            # Circular doubly linked list of [prev, next, key, value]
+            # links, most recently used first.
+            self._root = root = []
+            root[:] = [root, root, None, None]
+            self._links = {}
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._links)
+
+    def get(self, key, default=None):
+        """
+        Return the value of `key`, or `default` if it is not cached.
+        """
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is None:
+                return default
+            self._move_to_front(link)
+            return link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        """
+        Cache `value` for `key`.
+        """
+        if self.maxsize <= 0:
+            return
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                link[_VALUE] = value
+                self._move_to_front(link)
+                return
+            root = self._root
+            if len(self._links) >= self.maxsize:
+                oldest = root[_PREV]
+                oldest[_PREV][_NEXT] = root
+                root[_PREV] = oldest[_PREV]
+                del self._links[oldest[_KEY]]
+            first = root[_NEXT]
+            link = [root, first, key, value]
+            first[_PREV] = root[_NEXT] = self._links[key] = link
+        finally:
+            self._lock.release()
+
+    def _move_to_front(self, link):
+        root = self._root
+        if root[_NEXT] is link:
+            return
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+        first = root[_NEXT]
+        link[_PREV] = root
+        link[_NEXT] = first
+        first[_PREV] = root[_NEXT] = link
+
+
+def _decode_source(source):
+    # Same decoding as raven's get_lines_from_file.
+    encoding = 'utf8'
+    for line in source[:2]:
+        match = _coding_re.search(line.decode('utf8', 'replace'))
+        if match:
+            encoding = match.group(1)
+            break
+    try:
+        return [text_type(line, encoding, 'replace') for line in source]
+    except LookupError:
+        return [text_type(line, 'utf8', 'replace') for line in source]
+
+
+class SourceCache(object):
+    """
+    Cache of the lines around the current line of stack frames.
+
+    :param maxsize: maximum number of (filename, line number) pairs
+                    cached
+    :param max_files: maximum number of source files whose lines are
+                      cached
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, max_files=MAX_FILES):
+        self.snippets = LRUCache(maxsize)
+        self.files = LRUCache(min(maxsize, max_files))
+
+    def after_fork(self):
+        """
+        Make the caches usable in a child process.
+        """
+        self.snippets.after_fork()
+        self.files.after_fork()
+
+    def clear(self):
+        """
+        Forget every cached file and snippet.
+        """
+        self.snippets.clear()
+        self.files.clear()
+
+    def get_lines(self, filename, lineno, context_lines, loader=None,
+                  module_name=None):
+        """
+        Return (pre_context, context_line, post_context) around the
+        zero based `lineno` of `filename`, like raven's
+        `get_lines_from_file`.  The file is only read again when its
+        modification time changed.  Files which cannot be found on
+        disk are read through the module's `loader`, if any.
+        """
+        try:
+            mtime = os.stat(filename).st_mtime
+        except (OSError, IOError, TypeError, ValueError):
+            mtime = None
+
+        key = (filename, lineno, context_lines)
+        entry = self.snippets.get(key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        source = self._get_source(filename, mtime, loader, module_name)
+        snippet = None, None, None
+        if source is not None:
+            lower_bound = max(0, lineno - context_lines)
+            upper_bound = min(lineno + 1 + context_lines, len(source))
+            if 0 <= lineno < len(source):
+                snippet = (
+                    [line.strip('\r\n') for line in
+                     source[lower_bound:lineno]],
+                    source[lineno].strip('\r\n'),
+                    [line.strip('\r\n') for line in
+                     source[lineno + 1:upper_bound]])
+        self.snippets.set(key, (mtime, snippet))
+        return snippet
+
+    def _get_source(self, filename, mtime, loader, module_name):
+        entry = self.files.get(filename)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        source = None
+        if mtime is not None:
+            try:
+                f = open(filename, 'rb')
+                try:
+                    source = _decode_source(f.readlines())
+                finally:
+                    f.close()
+            except (OSError, IOError):
+                pass
+        elif loader is not None and hasattr(loader, 'get_source'):
+            try:
+                source = loader.get_source(module_name)
+            except ImportError:
+                source = None
+            if source is not None:
+                source = source.splitlines()
+
+        self.files.set(filename, (mtime, source))
+        return source
@@ -0,0 +1,157 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+`logging` integration.
+
+`HekaRavenHandler` forwards log records carrying exception information,
+such as those of `logger.exception(...)`, to the raven plugin, where
+they go through the same sampling, deduplication and background
+capture as exceptions caught by `capture_stack`::
+
+    import logging
+    from heka_raven.handler import HekaRavenHandler
+
+    logging.getLogger().addHandler(HekaRavenHandler())
+
+The handler never formats records: the message is taken from
+`record.getMessage()` and the stack from `record.exc_info`.  It
+requires `async` in the plugin configuration, so that the logging
+caller only pays for a snapshot of the traceback and never waits for
+the event to be built and sent.
+"""
+
+import logging
+
+from heka.client import SEVERITY
+from heka.holder import CLIENT_HOLDER
+from heka_raven.raven_plugin import HEKA_PLUGIN_NAME
+from heka_raven.raven_plugin import InvalidArgumentError
+
+# Records of these loggers, and of their children, are never
+# forwarded, the plugin and raven log their own errors to them.
+IGNORED_LOGGERS = ('heka_raven', 'raven', 'sentry.errors')
+
+logger = logging.getLogger('heka_raven.handler')
+
+# Heka (syslog) severity of each logging level, highest first.
+LEVEL_SEVERITIES = ((logging.CRITICAL, SEVERITY.CRITICAL),
+                    (logging.ERROR, SEVERITY.ERROR),
+                    (logging.WARNING, SEVERITY.WARNING),
+                    (logging.INFO, SEVERITY.INFORMATIONAL))
+
+
+def level_to_severity(levelno):
+    """
+    Return the heka severity matching the logging level `levelno`.
+    """
+    for level, severity in LEVEL_SEVERITIES:
+        if levelno >= level:
+            return severity
+    return SEVERITY.DEBUG
+
+
+class HekaRavenHandler(logging.Handler):
+    """
+    Logging handler sending records with exception information to the
+    raven plugin of a heka client.  The plugin must be configured with
+    `async`, otherwise `InvalidArgumentError` is raised when the
+    handler is created.  A client looked up after the handler was
+    created is only checked on the first record: if its plugin is
+    synchronous, a warning is logged once and records are captured
+    synchronously.
+
+    :param client: optional heka client with the raven plugin.  Will
+                   override `client_name`.
+    :param client_name: optional name of the heka client in heka's
+                        `CLIENT_HOLDER`.  If neither `client` nor
+                        `client_name` are given, the default client
+                        is used.
+    :param messages: set to True to also send records without
+                     exception information as sentry messages
+    :param level: minimum level of the records handled.  Default is
+                  `logging.ERROR`.
+    """
+
+    def __init__(self, client=None, client_name='', messages=False,
+                 level=logging.ERROR):
+        logging.Handler.__init__(self, level)
+        self._client = client
+        self.client_name = client_name
+        self.messages = messages
+        self._plugin_fn = None
+        self._severities = {}
+        if client is None and not client_name:
+            client = CLIENT_HOLDER.default_client
+        elif client is None:
+            client = CLIENT_HOLDER.get_client(client_name)
+        plugin_fn = getattr(client, HEKA_PLUGIN_NAME, None)
+        if plugin_fn is None and self._client is not None:
+            raise InvalidArgumentError(
+                "HekaRavenHandler requires a client with the raven plugin")
+        if plugin_fn is not None:
+            # Refuse a synchronous plugin once, here, rather than in
+            # emit where every record would report the error.
+            if plugin_fn.dispatcher is None:
+                raise InvalidArgumentError(
+                    "HekaRavenHandler requires the plugin's async option, "
+                    "emit must not block the logging caller")
+            self._client = client
+            self._plugin_fn = plugin_fn
+
+    @property
+    def client(self):
+        if self._client is None:
+            if self.client_name:
+                self._client = CLIENT_HOLDER.get_client(self.client_name)
+            else:
+                self._client = CLIENT_HOLDER.default_client
+        return self._client
+
+    @property
+    def plugin_fn(self):
+        if self._plugin_fn is None:
+            plugin_fn = getattr(self.client, HEKA_PLUGIN_NAME)
+            if plugin_fn.dispatcher is None:
+                logger.warning("HekaRavenHandler: the raven plugin is "
+                               "not configured with async, records are "
+                               "captured synchronously")
+            self._plugin_fn = plugin_fn
+        return self._plugin_fn
+
+    def handle(self, record):
+        # emit is thread safe, skipping the handler lock means threads
+        # logging at the same time never wait for each other.
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        try:
+            name = record.name
+            for ignored in IGNORED_LOGGERS:
+                if name == ignored or name.startswith(ignored + '.'):
+                    return
+
+            exc_info = record.exc_info
+            if not self.messages and (not exc_info or exc_info[0] is None):
+                return
+
+            severity = self._severities.get(record.levelno)
+            if severity is None:
+                severity = self._severities[record.levelno] = \
+                    level_to_severity(record.levelno)
+
+            plugin_fn = self.plugin_fn
+            if exc_info and exc_info[0] is not None:
+                plugin_fn(record.getMessage(), exc_info, name, severity)
+            else:
+                plugin_fn.capture_message(self.client, record.getMessage(),
+                                          name, severity)
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,1151 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Sentry events built without raven.
+
+`EventBuilder` stands in for `heka_raven.client.RavenClient`: it takes
+the same options, has the same `captureException` and
+`captureMessage` methods and returns the same payloads, but it builds
+events straight from `exc_info` and never imports raven.  Everything
+the two have in common, walking stacks, scrubbing, encoding and
+trimming, lives in `BaseEventBuilder`.
+
+Events are always built in the layout of Sentry's version 3 protocol,
+the one raven 3.4 sends, which is also what `fit` trims.  When the
+`V4` protocol is selected they are converted by `to_v4` as they are
+encoded, into the layout current Sentry versions expect:
+
+=================================  =====================================
+v3                                 v4
+=================================  =====================================
+'sentry.interfaces.Exception',     'exception': {'values': [...]}, oldest
+'sentry.interfaces.Stacktrace',    exception first, each with its own
+'exception_chain'                  'stacktrace' and chained ones with a
+                                   'mechanism'
+'sentry.interfaces.Message'        'logentry'
+'sentry.interfaces.User'           'user'
+'sentry.interfaces.Http'           'request'
+'level': 40                        'level': 'error'
+'timestamp': datetime              'timestamp': '2013-11-29T12:52:21.000000Z'
+'project', 'time_spent'            dropped
+=================================  =====================================
+
+v4 events can also be sent in the 'envelope' encoding, see
+`heka_raven.encoding`.
+"""
+
+import datetime
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import uuid
+
+try:
+    from urllib.parse import urlparse
+except ImportError:  # pragma: nocover
+    from urlparse import urlparse  # NOQA
+
+from heka_raven.dispatch import exception_chain
+from heka_raven.encoding import ENVELOPE
+from heka_raven.encoding import RAVEN
+from heka_raven.encoding import decode as decode_payload
+from heka_raven.encoding import get_encoder
+from heka_raven.encoding import get_stages
+from heka_raven.frames import CACHE_SIZE
+from heka_raven.frames import LRUCache
+from heka_raven.frames import SourceCache
+from heka_raven.serializer import MAX_DEPTH
+from heka_raven.serializer import MAX_ITEMS
+from heka_raven.serializer import MAX_REPR_LENGTH
+from heka_raven.serializer import VarsSerializer
+from heka_raven.serializer import binary_type
+from heka_raven.serializer import string_types
+from heka_raven.serializer import text_type
+from heka_raven.stats import clock
+
+V3 = 'v3'
+V4 = 'v4'
+PROTOCOLS = (V3, V4)
+
+# Builders the plugin can use.
+RAVEN_BUILDER = 'raven'
+NATIVE_BUILDER = 'native'
+BUILDERS = (RAVEN_BUILDER, NATIVE_BUILDER)
+
+# Length strings are cut to when trimming an oversized event.
+TRIMMED_LENGTH = 200
+
+# Number of source lines captured before and after each frame's line.
+CONTEXT_LINES = 5
+
+# Same default as raven.conf.defaults
+PROJECT = 1
+
+_LEVEL_NAMES = {
+    logging.DEBUG: 'debug',
+    logging.INFO: 'info',
+    logging.WARNING: 'warning',
+    logging.ERROR: 'error',
+    logging.CRITICAL: 'fatal',
+}
+
+# v3 interfaces and the v4 attributes replacing them, the others lose
+# their prefix.
+_INTERFACES = {
+    'sentry.interfaces.Message': 'logentry',
+    'sentry.interfaces.Http': 'request',
+    'sentry.interfaces.User': 'user',
+    'sentry.interfaces.Stacktrace': 'stacktrace',
+}
+_INTERFACE_PREFIX = 'sentry.interfaces.'
+
+_MECHANISM_SOURCES = {'cause': '__cause__', 'context': '__context__'}
+
+_V4_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# What raven's `SanitizePasswordsProcessor` masks, see
+# `sanitize_passwords`.
+_SANITIZE_MASK = '*' * 8
+_SANITIZE_FIELDS = ('password', 'secret', 'passwd', 'authorization')
+_SANITIZE_VALUES_RE = re.compile(r'^(?:\d[ -]*?){13,16}$')
+_SANITIZE_HTTP = ('data', 'cookies', 'headers', 'env', 'query_string')
+
+
+def _getitem_from_frame(f_locals, key, default=None):
+    # f_locals is not guaranteed to have .get(), but it will always
+    # support __getitem__.
+    try:
+        return f_locals[key]
+    except Exception:
+        return default
+
+
+def to_dict(dictish):
+    """
+    Coerce something that closely resembles a dictionary into one.
+    """
+    if hasattr(dictish, 'iterkeys'):
+        keys = dictish.iterkeys
+    elif hasattr(dictish, 'keys'):
+        keys = dictish.keys
+    else:
+        raise ValueError(dictish)
+    return dict((k, dictish[k]) for k in keys())
+
+
+def to_text(value):
+    """
+    Return `value` as text, the way raven's `to_unicode` does.
+    """
+    if isinstance(value, text_type):
+        return value
+    try:
+        if isinstance(value, binary_type):
+            return value.decode('utf8')
+        if hasattr(value, '__unicode__'):
+            return value.__unicode__()
+        if binary_type is str:
+            return str(value).decode('utf8')
+        return str(value)
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return text_type('(Error decoding value)')
+    except Exception:
+        try:
+            return text_type(repr(type(value)))
+        except Exception:
+            return text_type('(Error decoding value)')
+
+
+def iter_traceback_frames(tb):
+    """
+    Yield the (frame, lineno) pairs of a traceback, leaving out frames
+    hidden with `__traceback_hide__`.
+    """
+    while tb:
+        f_locals = getattr(tb.tb_frame, 'f_locals', {})
+        if not _getitem_from_frame(f_locals, '__traceback_hide__'):
+            yield tb.tb_frame, getattr(tb, 'tb_lineno', None)
+        tb = tb.tb_next
+
+
+def stack_frames(depth=0):
+    """
+    Return the (frame, lineno) pairs of the current stack, innermost
+    first, starting `depth` frames above the caller and leaving out
+    frames hidden with `__traceback_hide__`.  Unlike raven's
+    `iter_stack_frames`, no source is read: the frames are walked
+    directly.
+    """
+    result = []
+    frame = sys._getframe(depth + 1)
+    while frame is not None:
+        f_locals = getattr(frame, 'f_locals', {})
+        if not _getitem_from_frame(f_locals, '__traceback_hide__'):
+            result.append((frame, frame.f_lineno))
+        frame = frame.f_back
+    return result
+
+
+def label_from_frame(frame):
+    module = frame.get('module') or '?'
+    function = frame.get('function') or '?'
+    if module == function == '?':
+        return ''
+    return '%s in %s' % (module, function)
+
+
+def get_culprit(frames):
+    """
+    Return the "module in function" label of the innermost application
+    frame of `frames`, or the best guess if none is marked `in_app`.
+    """
+    best_guess = None
+    culprit = None
+    for frame in reversed(frames):
+        culprit = label_from_frame(frame)
+        if not culprit:
+            culprit = None
+            continue
+        if frame.get('in_app'):
+            return culprit
+        elif not best_guess:
+            best_guess = culprit
+        else:
+            break
+    return best_guess or culprit
+
+
+def dsn_project(dsn):
+    """
+    Return the project id at the end of the path of a Sentry DSN.
+    """
+    project = urlparse(dsn).path.rsplit('/', 1)[-1]
+    if not project:
+        raise ValueError("Invalid Sentry DSN: %r" % (dsn,))
+    return project
+
+
+_VERSION_CACHE = {}
+
+
+def get_versions(module_list):
+    """
+    Return the versions of the modules, and of their parent packages,
+    named in `module_list`, like raven's `get_versions` but without
+    falling back to pkg_resources.
+    """
+    names = set()
+    for name in module_list or ():
+        parts = name.split('.')
+        names.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+
+    versions = {}
+    for name in names:
+        if name not in _VERSION_CACHE:
+            version = None
+            try:
+                __import__(name)
+                module = sys.modules[name]
+                version = getattr(module, 'get_version', None)
+                if callable(version):
+                    version = version()
+                if version is None:
+                    version = getattr(module, 'VERSION', None)
+                if version is None:
+                    version = getattr(module, '__version__', None)
+                if isinstance(version, (list, tuple)):
+                    version = '.'.join(str(v) for v in version)
+                if version is not None:
+                    version = str(version)
+            except Exception:
+                version = None
+            _VERSION_CACHE[name] = version
+        version = _VERSION_CACHE[name]
+        if version is not None:
+            versions[name] = version
+    return versions
+
+
+def _trim_text(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if not isinstance(value, string_types):
+        value = repr(value)
+    if len(value) > TRIMMED_LENGTH:
+        value = value[:TRIMMED_LENGTH] + '...'
+    return value
+
+
+def _annotate(annotations, key, count):
+    if annotations is not None and count:
+        annotations[key] = annotations.get(key, 0) + count
+
+
+def _describe_exception(exc_type, exc_value):
+    exc_module = getattr(exc_type, '__module__', None)
+    if exc_module:
+        exc_module = str(exc_module)
+    return {
+        'value': to_text(exc_value),
+        'type': str(getattr(exc_type, '__name__', '<unknown>')),
+        'module': to_text(exc_module),
+    }
+
+
+def _sanitize(key, value):
+    if value is None:
+        return
+    if (isinstance(value, string_types) and
+            _SANITIZE_VALUES_RE.match(value)):
+        return _SANITIZE_MASK
+    if not key or not isinstance(key, string_types):
+        return value
+    key = key.lower()
+    for field in _SANITIZE_FIELDS:
+        if field in key:
+            return _SANITIZE_MASK
+    return value
+
+
+def _varmap(func, var, context=None, name=None):
+    # raven.utils.varmap
+    if context is None:
+        context = {}
+    objid = id(var)
+    if objid in context:
+        return func(name, '<...>')
+    context[objid] = 1
+    if isinstance(var, dict):
+        ret = dict((k, _varmap(func, v, context, k))
+                   for k, v in var.items())
+    elif isinstance(var, (list, tuple)):
+        ret = [_varmap(func, f, context, name) for f in var]
+    else:
+        ret = func(name, var)
+    del context[objid]
+    return ret
+
+
+def sanitize_passwords(data):
+    """
+    Mask passwords and card numbers in the frame variables and the
+    HTTP interface of a v3 event, in place, exactly as raven's
+    `SanitizePasswordsProcessor` does.  `EventBuilder` runs this when
+    no scrubber is set, like `RavenClient` runs the processor.
+    """
+    stacktrace = data.get('sentry.interfaces.Stacktrace')
+    if stacktrace and 'frames' in stacktrace:
+        for frame in stacktrace['frames']:
+            if 'vars' in frame:
+                frame['vars'] = _varmap(_sanitize, frame['vars'])
+
+    http = data.get('sentry.interfaces.Http')
+    if not http:
+        return
+    for n in _SANITIZE_HTTP:
+        if n not in http:
+            continue
+        if isinstance(http[n], string_types) and '=' in http[n]:
+            querybits = []
+            for bit in http[n].split('&'):
+                chunk = bit.split('=')
+                if len(chunk) == 2:
+                    querybits.append((chunk[0], _sanitize(*chunk)))
+                else:
+                    querybits.append(chunk)
+            http[n] = '&'.join('='.join(k) for k in querybits)
+        else:
+            http[n] = _varmap(_sanitize, http[n])
+
+
+def _exception_to_string(data):
+    exc = data['sentry.interfaces.Exception']
+    if exc['value']:
+        return '%s: %s' % (exc['type'], exc['value'])
+    return exc['type']
+
+
+def _v4_exception(entry, frames, relation=None):
+    value = {
+        'type': entry.get('type'),
+        'value': entry.get('value'),
+        'module': entry.get('module'),
+        'stacktrace': {'frames': frames},
+    }
+    if relation is not None:
+        value['mechanism'] = {'type': 'chained',
+                              'source': _MECHANISM_SOURCES.get(relation,
+                                                               relation)}
+    return value
+
+
+def to_v4(data):
+    """
+    Return the v3 event `data` converted to the layout of the current
+    Sentry protocol.  `data` is left untouched, its frames are shared
+    with the result.
+    """
+    result = {}
+    exception = data.get('sentry.interfaces.Exception')
+    for key, value in data.items():
+        if key in ('project', 'time_spent', 'exception_chain',
+                   'sentry.interfaces.Exception'):
+            continue
+        if key == 'sentry.interfaces.Stacktrace' and exception is not None:
+            continue
+        if key == 'message' and (exception is not None or
+                                 'sentry.interfaces.Message' in data):
+            # Sentry derives the title from the exception or log entry.
+            continue
+        if key.startswith(_INTERFACE_PREFIX):
+            key = _INTERFACES.get(key) or key[len(_INTERFACE_PREFIX):].lower()
+        elif key == 'level':
+            value = _LEVEL_NAMES.get(value, value)
+        elif key == 'timestamp' and isinstance(value, datetime.datetime):
+            value = value.strftime(_V4_TIMESTAMP_FORMAT)
+        result[key] = value
+
+    if exception is not None:
+        # Oldest first, the captured exception last.
+        values = []
+        for entry in reversed(data.get('exception_chain') or ()):
+            values.append(_v4_exception(entry, entry.get('frames') or [],
+                                        entry.get('relation')))
+        stacktrace = data.get('sentry.interfaces.Stacktrace') or {}
+        values.append(_v4_exception(exception,
+                                    stacktrace.get('frames') or []))
+        result['exception'] = {'values': values}
+    return result
+
+
+class BaseEventBuilder(object):
+    """
+    The parts of building and encoding events shared by
+    `EventBuilder` and `heka_raven.client.RavenClient`.  Subclasses
+    call `_configure` from their constructor and provide `build_msg`,
+    `include_paths`, `exclude_paths`, `string_max_length` and
+    `list_max_length`.
+    """
+
+    def _configure(self, max_frames=None, max_locals=None,
+                   max_depth=MAX_DEPTH, include_vars=None, exclude_vars=None,
+                   encoding=RAVEN, stats=None, max_payload_size=None,
+                   frame_cache_size=CACHE_SIZE, scrubber=None, protocol=V3):
+        if protocol not in PROTOCOLS:
+            raise ValueError("Unknown protocol: %r" % (protocol,))
+        if encoding == ENVELOPE and protocol != V4:
+            raise ValueError("The %r encoding requires the %r protocol"
+                             % (ENVELOPE, V4))
+        self.max_frames = max_frames
+        self.max_locals = max_locals
+        self.max_depth = max_depth
+        self.include_vars = include_vars and frozenset(include_vars)
+        self.exclude_vars = exclude_vars and frozenset(exclude_vars)
+        self.encoding = encoding
+        self._encode = get_encoder(encoding)
+        self._dumps, self._compress = get_stages(encoding)
+        self.protocol = protocol
+        self.stats = stats
+        self.max_payload_size = max_payload_size
+        self.scrubber = scrubber
+        self.source_cache = SourceCache(frame_cache_size)
+        self.code_cache = LRUCache(frame_cache_size)
+        self._static_data = None
+        self._static_lock = threading.Lock()
+
+    def after_fork(self):
+        """
+        Replace the locks inherited from the parent process, which may
+        have been held by another thread when it forked.  The caches
+        and static data are still valid and are kept.
+        """
+        self._static_lock = threading.Lock()
+        self.source_cache.after_fork()
+        self.code_cache.after_fork()
+
+    def get_static_data(self):
+        """
+        Return the cached static envelope, computing it if needed.
+        """
+        static_data = self._static_data
+        if static_data is None:
+            static_data = self.refresh_static_data()
+        return static_data
+
+    def _set_static_data(self, static_data):
+        self._static_lock.acquire()
+        try:
+            self._static_data = static_data
+        finally:
+            self._static_lock.release()
+        return static_data
+
+    def _is_in_app(self, module_name):
+        if module_name.startswith('raven.'):
+            return False
+        return (any(module_name.startswith(x) for x in self.include_paths)
+                and not
+                any(module_name.startswith(x) for x in self.exclude_paths))
+
+    def _mark_in_app(self, frames):
+        # Frames serialized without a code object were not looked up
+        # in the code cache, which works out `in_app` for the others.
+        if not self.include_paths:
+            return
+        for frame in frames:
+            if frame.get('in_app') is not None:
+                continue
+            path = frame.get('module')
+            if path:
+                frame['in_app'] = self._is_in_app(path)
+
+    def _exception_data(self, exc_info, annotations=None, chain=None,
+                        level=logging.ERROR):
+        """
+        Return the exception and stacktrace interfaces of an event for
+        `exc_info`, and its 'exception_chain'.
+
+        The exceptions the captured one was raised from or while
+        handling are added as an 'exception_chain' list, most recent
+        first, each with its type, value, module, relation ('cause' or
+        'context') and frames.  The variables of a frame found in
+        several tracebacks of the chain are serialized once.
+        """
+        if not exc_info or exc_info is True:
+            exc_info = sys.exc_info()
+
+        if not exc_info:
+            raise ValueError('No exception found')
+
+        exc_type, exc_value, exc_traceback = exc_info
+        if chain is None:
+            chain = exception_chain(exc_value)
+
+        try:
+            serializer = self._vars_serializer()
+            transformer = serializer.transform_locals
+            if chain:
+                # The variables of a frame found in several tracebacks
+                # of the chain are only serialized once.
+                shared = {}
+
+                def transformer(f_locals):
+                    key = id(f_locals)
+                    entry = shared.get(key)
+                    if entry is None:
+                        # Keep f_locals alive so that its id is not
+                        # reused.
+                        entry = shared[key] = (
+                            f_locals, serializer.transform_locals(f_locals))
+                    return entry[1]
+
+            frames, frames_omitted = self._stack_frames(
+                iter_traceback_frames(exc_traceback), transformer)
+
+            result = {
+                'level': level,
+                'sentry.interfaces.Exception':
+                    _describe_exception(exc_type, exc_value),
+                'sentry.interfaces.Stacktrace': {
+                    'frames': frames
+                },
+            }
+            if chain:
+                result['exception_chain'] = chained = []
+                for relation, (cause_type, cause, cause_tb) in chain:
+                    entry = _describe_exception(cause_type, cause)
+                    entry['relation'] = relation
+                    entry['frames'], omitted = self._stack_frames(
+                        iter_traceback_frames(cause_tb), transformer)
+                    frames_omitted += omitted
+                    chained.append(entry)
+            self._annotate_frames(annotations, serializer, frames_omitted)
+            return result
+        finally:
+            del exc_type, exc_value, exc_traceback, chain
+
+    def _scrub_text(self, data, annotations):
+        # The exception values, and the message, of an event: strings
+        # only need the patterns applied.  The HTTP interface is passed
+        # in by the caller and has not been through the serializer.
+        scrubbed = 0
+        http = data.get('sentry.interfaces.Http')
+        if http:
+            scrubbed += self.scrubber.scrub_http(http)
+        targets = [data, data.get('sentry.interfaces.Message'),
+                   data.get('sentry.interfaces.Exception')]
+        targets.extend(data.get('exception_chain') or ())
+        for target in targets:
+            if not target:
+                continue
+            for key in ('message', 'value'):
+                value = target.get(key)
+                if isinstance(value, string_types):
+                    target[key], count = self.scrubber.scrub(value)
+                    scrubbed += count
+        _annotate(annotations, 'values_scrubbed', scrubbed)
+
+    def get_stack_info(self, frames, annotations=None):
+        """
+        Serialize `frames`, an iterable of (frame, lineno) pairs,
+        within the limits configured on this client.
+
+        :param annotations: optional dict which will be updated with
+                            counts of the frames, variables and values
+                            that were left out
+        """
+        serializer = self._vars_serializer()
+        result, frames_omitted = self._stack_frames(
+            frames, serializer.transform_locals)
+        self._annotate_frames(annotations, serializer, frames_omitted)
+        return result
+
+    def _vars_serializer(self):
+        return VarsSerializer(max_locals=self.max_locals,
+                              max_items=self.list_max_length,
+                              max_repr_length=self.string_max_length,
+                              max_depth=self.max_depth,
+                              include_vars=self.include_vars,
+                              exclude_vars=self.exclude_vars,
+                              scrubber=self.scrubber)
+
+    def _stack_frames(self, frames, transformer):
+        # The serialized frames, and the number of frames left out.
+        frames = list(frames)
+        frames_omitted = 0
+        if self.max_frames and len(frames) > self.max_frames:
+            # Keep the outermost and innermost frames, the culprit is
+            # always the innermost one.
+            head = self.max_frames // 2
+            tail = self.max_frames - head
+            frames_omitted = len(frames) - self.max_frames
+            frames = frames[:head] + frames[-tail:]
+
+        result = []
+        for frame, lineno in frames:
+            frame_result = self._get_frame_info(frame, lineno, transformer)
+            if frame_result is not None:
+                result.append(frame_result)
+        return result, frames_omitted
+
+    def _annotate_frames(self, annotations, serializer, frames_omitted):
+        for key, count in (('frames_omitted', frames_omitted),
+                           ('vars_omitted', serializer.vars_omitted),
+                           ('values_truncated', serializer.values_truncated),
+                           ('values_scrubbed', serializer.values_scrubbed)):
+            _annotate(annotations, key, count)
+
+    def _get_code_info(self, frame):
+        # Everything about a frame which only depends on its code
+        # object: (abs_path, filename, module, function, loader, in_app)
+        code = frame.f_code
+        info = self.code_cache.get(code)
+        if info is not None:
+            return info
+
+        f_globals = getattr(frame, 'f_globals', {})
+        abs_path = code.co_filename
+        loader = _getitem_from_frame(f_globals, '__loader__')
+        module_name = _getitem_from_frame(f_globals, '__name__')
+
+        # Try to pull a relative file path
+        # This changes /foo/site-packages/baz/bar.py into baz/bar.py
+        try:
+            base_filename = sys.modules[module_name.split('.', 1)[0]].__file__
+            filename = abs_path.split(base_filename.rsplit('/', 2)[0], 1)[-1][1:]
+        except Exception:
+            filename = abs_path
+        if not filename:
+            filename = abs_path
+
+        in_app = None
+        if self.include_paths and module_name:
+            in_app = self._is_in_app(module_name)
+
+        info = (abs_path, filename, module_name or None, code.co_name,
+                loader, in_app)
+        self.code_cache.set(code, info)
+        return info
+
+    def _get_frame_info(self, frame, lineno, transformer):
+        """
+        Serialize a single frame the way raven's `get_stack_info` does,
+        looking up source lines and code details in the caches.
+        Returns None for frames hidden with `__traceback_hide__`.
+        """
+        f_locals = getattr(frame, 'f_locals', {})
+        if _getitem_from_frame(f_locals, '__traceback_hide__'):
+            return None
+
+        if getattr(frame, 'f_code', None) is None:
+            abs_path = filename = function = loader = in_app = None
+            module_name = _getitem_from_frame(
+                getattr(frame, 'f_globals', {}), '__name__') or None
+        else:
+            (abs_path, filename, module_name, function, loader,
+             in_app) = self._get_code_info(frame)
+
+        if lineno:
+            lineno -= 1
+        if lineno is not None and abs_path:
+            pre_context, context_line, post_context = \
+                self.source_cache.get_lines(abs_path, lineno, CONTEXT_LINES,
+                                            loader, module_name)
+        else:
+            pre_context, context_line, post_context = None, None, None
+
+        if f_locals is not None and not isinstance(f_locals, dict):
+            # XXX: Genshi (and maybe others) have broken implementations of
+            # f_locals that are not actually dictionaries
+            try:
+                f_locals = to_dict(f_locals)
+            except Exception:
+                f_locals = '<invalid local scope>'
+
+        frame_result = {
+            'abs_path': abs_path,
+            'filename': filename,
+            'module': module_name,
+            'function': function or '<unknown>',
+            'lineno': lineno + 1,
+            'vars': transformer(f_locals),
+        }
+        if context_line is not None:
+            frame_result.update({
+                'pre_context': pre_context,
+                'context_line': context_line,
+                'post_context': post_context,
+            })
+        if in_app is not None:
+            frame_result['in_app'] = in_app
+        return frame_result
+
+    def _payload_data(self, data):
+        if self.protocol == V4:
+            return to_v4(data)
+        return data
+
+    def encode(self, data):
+        """
+        Serializes ``data`` using the configured encoding and protocol.
+        """
+        return self._encode(self._payload_data(data))
+
+    def decode(self, data):
+        """
+        Unserializes a payload produced with any of the encodings.
+        """
+        return decode_payload(data)
+
+    def capture(self, event_type, data=None, date=None, time_spent=None,
+                extra=None, stack=None, **kwargs):
+        """
+        Captures, processes and encodes an event.
+
+        To use structured data (interfaces) with capture:
+
+        >>> capture('Message', message='foo', data={
+        >>>     'sentry.interfaces.Http': {
+        >>>         'url': '...',
+        >>>         'data': {},
+        >>>         'query_string': '...',
+        >>>         'method': 'POST',
+        >>>     },
+        >>>     'logger': 'logger.name',
+        >>>     'site': 'site.name',
+        >>> }, extra={
+        >>>     'key': 'value',
+        >>> })
+
+        The finalized ``data`` structure contains the following (some optional)
+        builtin values:
+
+        >>> {
+        >>>     # the culprit and version information
+        >>>     'culprit': 'full.module.name', # or /arbitrary/path
+        >>>
+        >>>     # all detectable installed modules
+        >>>     'modules': {
+        >>>         'full.module.name': 'version string',
+        >>>     },
+        >>>
+        >>>     # arbitrary data provided by user
+        >>>     'extra': {
+        >>>         'key': 'value',
+        >>>     }
+        >>> }
+
+        :param event_type: the module path to the Event class. Builtins can use
+                           shorthand class notation and exclude the full module
+                           path.
+        :param data: the data base, useful for specifying structured data
+                           interfaces. Any key which contains a '.' will be
+                           assumed to be a data interface.
+        :param date: the datetime of this event
+        :param time_spent: a float value representing the duration of the event
+        :param extra: a dictionary of additional standard metadata
+        :param culprit: a string representing the cause of this event
+                        (generally a path to a function)
+        :return: the encoded event, or None if it is larger than
+                 `max_payload_size` even after trimming
+        """
+
+        stats = self.stats
+        if stats is not None:
+            return self._capture_timed(stats, event_type, data, date,
+                                       time_spent, extra, stack, **kwargs)
+
+        data = self.build_msg(event_type, data, date, time_spent,
+                extra, stack, **kwargs)
+
+        if 'public_key' in data:
+            del data['public_key']
+
+        message = self.encode(data)
+        if self.max_payload_size and len(message) > self.max_payload_size:
+            message = self.fit(data, message, kwargs.get('annotations'))
+
+        # The standard raven client normally sends data out here
+        return message
+
+    def _capture_timed(self, stats, event_type, data, date, time_spent,
+                       extra, stack, **kwargs):
+        """
+        `capture`, recording the time spent in `build_msg` and encoding
+        and the size of the payload before and after compression.
+        """
+        start = clock()
+        data = self.build_msg(event_type, data, date, time_spent,
+                extra, stack, **kwargs)
+        if 'public_key' in data:
+            del data['public_key']
+        built = clock()
+
+        payload_data = self._payload_data(data)
+        if self._dumps is None:
+            sizes = {}
+            message = self._encode(payload_data, sizes)
+            raw_bytes = sizes['raw_bytes']
+        else:
+            text = self._dumps(payload_data)
+            raw_bytes = len(text)
+            if self._compress is not None:
+                message = self._compress(text)
+            else:
+                message = text
+        if self.max_payload_size and len(message) > self.max_payload_size:
+            message = self.fit(data, message, kwargs.get('annotations'))
+            stats.incr('trimmed' if message is not None else 'oversized')
+            if message is None:
+                return None
+        stats.timing('build_msg', built - start)
+        stats.timing('encode', clock() - built)
+        stats.size('raw_bytes', raw_bytes)
+        stats.size('encoded_bytes', len(message))
+        return message
+
+    def fit(self, data, message, annotations=None):
+        """
+        Trim the event `data`, whose encoded form `message` is larger
+        than `max_payload_size`, until it fits.  Each step is only
+        taken if the previous ones were not enough:
+
+        1. drop the local variables and source context of every frame
+        2. drop the frames of the chained exceptions
+        3. drop frames from the middle of the stack, halving the
+           number of frames kept each time, down to the outermost and
+           innermost frames
+        4. cut the message, exception values and extra data to
+           `TRIMMED_LENGTH` characters and drop the module versions
+
+        Returns the encoded trimmed event, or None if it is still too
+        large.  `annotations` is updated with the size of the event
+        before trimming, the steps taken ('vars', 'chain', 'frames'
+        and 'text') and the number of frames dropped.
+        """
+        limit = self.max_payload_size
+        steps = []
+        if annotations is not None:
+            annotations['untrimmed_size'] = len(message)
+
+        stacktrace = data.get('sentry.interfaces.Stacktrace') or {}
+        frames = stacktrace.get('frames') or []
+        chain = data.get('exception_chain') or []
+        all_frames = list(frames)
+        for entry in chain:
+            all_frames.extend(entry['frames'])
+        if any('vars' in f or 'pre_context' in f for f in all_frames):
+            for frame in all_frames:
+                frame.pop('vars', None)
+                frame.pop('pre_context', None)
+                frame.pop('post_context', None)
+            steps.append('vars')
+            message = self.encode(data)
+
+        if len(message) > limit and any(entry['frames'] for entry in chain):
+            for entry in chain:
+                entry['frames'] = []
+            steps.append('chain')
+            message = self.encode(data)
+
+        omitted = 0
+        while len(message) > limit and len(frames) > 2:
+            keep = max(2, len(frames) // 2)
+            tail = keep // 2
+            omitted += len(frames) - keep
+            frames = frames[:keep - tail] + frames[len(frames) - tail:]
+            stacktrace['frames'] = frames
+            message = self.encode(data)
+        if omitted:
+            steps.append('frames')
+
+        if len(message) > limit:
+            for key in ('message', 'culprit'):
+                if key in data:
+                    data[key] = _trim_text(data[key])
+            exception = data.get('sentry.interfaces.Exception')
+            for exception in [exception] + chain:
+                if exception and 'value' in exception:
+                    exception['value'] = _trim_text(exception['value'])
+            if data.get('extra'):
+                data['extra'] = dict((k, _trim_text(v))
+                                     for k, v in data['extra'].items())
+            data['modules'] = {}
+            steps.append('text')
+            message = self.encode(data)
+
+        if annotations is not None:
+            annotations['trimmed'] = ','.join(steps)
+            if omitted:
+                annotations['frames_omitted'] = (
+                    annotations.get('frames_omitted', 0) + omitted)
+
+        if len(message) > limit:
+            return None
+        return message
+
+
+class EventBuilder(BaseEventBuilder):
+    """
+    Builds and encodes Sentry events without raven.  It accepts the
+    options of `heka_raven.client.RavenClient` that matter when
+    nothing is sent over the network, and produces the same events.
+
+    :param dsn: optional Sentry DSN, only its project id is used.
+                Defaults to the `SENTRY_DSN` environment variable.
+    :param project: project id used when there is no DSN
+    :param name: server name, defaults to the host name
+    :param site: optional site, added to every event as a tag
+    :param include_paths: module prefixes of the application, used to
+                          mark frames `in_app` and to report module
+                          versions
+    :param exclude_paths: module prefixes never marked `in_app`
+    :param string_max_length: maximum length of captured strings
+    :param list_max_length: maximum number of items of captured
+                            containers
+    :param auto_log_stacks: set to True to add the current stack to
+                            message events
+    :param include_versions: set to False to leave out module versions
+    :param context: extra data added to every event, defaults to
+                    `sys.argv`
+    :param scrubber: optional `heka_raven.scrub.Scrubber` masking
+                     secrets.  Without one, passwords are masked by
+                     `sanitize_passwords`, as raven does.
+    :param protocol: `V3` (the default) or `V4`, see `to_v4`
+
+    The `max_frames`, `max_locals`, `max_depth`, `include_vars`,
+    `exclude_vars`, `encoding`, `stats`, `max_payload_size` and
+    `frame_cache_size` options are those of `RavenClient`.
+    """
+
+    def __init__(self, dsn=None, project=None, name=None, site=None,
+                 include_paths=None, exclude_paths=None,
+                 string_max_length=None, list_max_length=None,
+                 auto_log_stacks=False, include_versions=True, context=None,
+                 scrubber=None, **options):
+        if dsn is None:
+            dsn = os.environ.get('SENTRY_DSN')
+        if dsn:
+            project = dsn_project(dsn)
+        self.project = project or PROJECT
+        self.name = to_text(name or socket.gethostname())
+        self.site = site
+        self.include_paths = set(include_paths or ())
+        self.exclude_paths = set(exclude_paths or ())
+        self.string_max_length = int(string_max_length or MAX_REPR_LENGTH)
+        self.list_max_length = int(list_max_length or MAX_ITEMS)
+        self.auto_log_stacks = bool(auto_log_stacks)
+        self.include_versions = include_versions
+        if context is None:
+            context = {'sys.argv': sys.argv[:]}
+        self.extra = context
+        self._configure(scrubber=scrubber, **options)
+
+    def get_module_versions(self):
+        if not self.include_versions:
+            return {}
+        return get_versions(self.include_paths)
+
+    def _serializer(self):
+        return VarsSerializer(max_items=self.list_max_length,
+                              max_repr_length=self.string_max_length,
+                              max_depth=self.max_depth,
+                              scrubber=self.scrubber)
+
+    def _transform_extra(self, extra, serializer):
+        scrubber = self.scrubber
+        result = {}
+        for k, v in extra.items():
+            if scrubber is not None and scrubber.sensitive_key(k):
+                serializer.values_scrubbed += 1
+                result[k] = scrubber.mask
+            else:
+                result[k] = serializer.transform(v)
+        return result
+
+    def refresh_static_data(self):
+        """
+        (Re)compute the parts of every event which do not change for
+        the life of the process: installed module versions, server
+        name, site, project and the serialized client context.  This
+        is done once, on the first capture, unless called explicitly.
+        """
+        return self._set_static_data({
+            'server_name': self.name,
+            'modules': self.get_module_versions(),
+            'project': self.project,
+            'site': self.site,
+            'extra': self._transform_extra(self.extra or {},
+                                           self._serializer()),
+        })
+
+    def build_msg(self, event_type, data=None, date=None,
+                  time_spent=None, extra=None, stack=None, tags=None,
+                  exc_info=None, message=None, params=(), formatted=None,
+                  annotations=None, chain=None, level=None, **kwargs):
+        """
+        Build the v3 event of type `event_type`, 'Exception' or
+        'Message', as raven's `Client.build_msg` would.  Other raven
+        event types are not supported.
+        """
+        static_data = self.get_static_data()
+        event_id = uuid.uuid4().hex
+
+        if data is None:
+            data = {}
+        if extra is None:
+            extra = {}
+        if not date:
+            date = datetime.datetime.utcnow()
+        if stack is None:
+            stack = self.auto_log_stacks
+
+        serializer = self._serializer()
+        kind = event_type.rsplit('.', 1)[-1]
+        if kind in ('Exception', 'ExceptionEvent'):
+            result = self._exception_data(exc_info, annotations, chain,
+                                          level or logging.ERROR)
+        elif kind == 'Message':
+            message = to_text(message)
+            result = {
+                'sentry.interfaces.Message': {
+                    'message': message,
+                    'params': serializer.transform(params),
+                },
+                'message': formatted or message,
+            }
+        else:
+            raise ValueError("Unsupported event type: %r" % (event_type,))
+
+        culprit = data.get('culprit') or None
+        for k, v in result.items():
+            if k not in data:
+                data[k] = v
+
+        if self.scrubber is not None:
+            self._scrub_text(data, annotations)
+
+        if stack and 'sentry.interfaces.Stacktrace' not in data:
+            if stack is True:
+                frames = stack_frames()
+            else:
+                frames = stack
+            data['sentry.interfaces.Stacktrace'] = {
+                'frames': self.get_stack_info(frames, annotations),
+            }
+
+        if 'sentry.interfaces.Stacktrace' in data:
+            frames = data['sentry.interfaces.Stacktrace']['frames']
+            self._mark_in_app(frames)
+            if not culprit:
+                culprit = get_culprit(frames)
+
+        if not data.get('level'):
+            data['level'] = level or logging.ERROR
+
+        if not data.get('server_name'):
+            data['server_name'] = static_data['server_name']
+
+        if not data.get('modules'):
+            data['modules'] = static_data['modules']
+
+        data['tags'] = tags or {}
+
+        event_extra = data.setdefault('extra', {})
+        for k, v in extra.items():
+            event_extra[k] = v
+        data['extra'] = event_extra = self._transform_extra(event_extra,
+                                                            serializer)
+        _annotate(annotations, 'values_scrubbed', serializer.values_scrubbed)
+        for k, v in static_data['extra'].items():
+            event_extra.setdefault(k, v)
+
+        if culprit:
+            data['culprit'] = culprit
+
+        if self.scrubber is None:
+            sanitize_passwords(data)
+
+        if 'message' not in data:
+            data['message'] = _exception_to_string(data)
+
+        data.setdefault('project', static_data['project'])
+
+        site = data.pop('site', None) or static_data['site']
+        if site:
+            data['tags'].setdefault('site', site)
+
+        for key, value in data['tags'].items():
+            data['tags'][key] = to_text(value)
+
+        data.update({
+            'timestamp': date,
+            'time_spent': time_spent,
+            'event_id': event_id,
+            'platform': 'python',
+        })
+        return data
+
+    def captureException(self, exc_info=None, **kwargs):
+        """
+        Creates an event from an exception.
+
+        :param annotations: optional dict which will be updated with
+                            counts of anything left out of the event to
+                            keep it within the configured limits
+        """
+        return self.capture('Exception', exc_info=exc_info, **kwargs)
+
+    def captureMessage(self, message, **kwargs):
+        """
+        Creates an event from ``message``.
+        """
+        return self.capture('Message', message=message, **kwargs)
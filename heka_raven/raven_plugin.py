@@ -5,87 +5,269 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
 
-# Code to reconstruct the frame as a JSON serializable
-from raven import Client
-
+import atexit
+import os
+import random
+import re
 import sys
+import threading
+import weakref
 
 from heka.decorators.base import HekaDecorator
 from heka.client import SEVERITY
-import time
+from heka_raven.batch import Batcher
+from heka_raven.batch import MAX_BYTES as BATCH_MAX_BYTES
+from heka_raven.context import capture_options
+from heka_raven.context import get_current as get_current_context
+from heka_raven.dedup import CAPTURE, SUPPRESS
+from heka_raven.dedup import Deduplicator
+from heka_raven.dedup import fingerprint
+from heka_raven.dedup import fingerprint_id
+from heka_raven.dispatch import ThreadDispatcher
+from heka_raven.dispatch import snapshot_chain
+from heka_raven.encoding import ENVELOPE
+from heka_raven.encoding import RAVEN
+from heka_raven.encoding import get_encoder
+from heka_raven.frames import CACHE_SIZE
+from heka_raven.protocol import BUILDERS
+from heka_raven.protocol import NATIVE_BUILDER
+from heka_raven.protocol import PROTOCOLS
+from heka_raven.protocol import RAVEN_BUILDER
+from heka_raven.protocol import V3
+from heka_raven.rollup import Rollup
+from heka_raven.rollup import rollup_key
+from heka_raven.routing import Router
+from heka_raven.routing import parse_routes
+from heka_raven.sampling import Sampler
+from heka_raven.sampling import parse_rates
+from heka_raven.scrub import Scrubber
+from heka_raven.serializer import MAX_DEPTH
+from heka_raven.serializer import string_types
+from heka_raven.spool import Spool
+from heka_raven.spool import SpoolingSender
+from heka_raven.stats import Reporter
+from heka_raven.stats import Stats
+from heka_raven.stats import clock
 
 HEKA_PLUGIN_NAME = 'raven'
 
+# Attribute set on exceptions once they went through the plugin, so that
+# outer `capture_stack` layers do not report them again.  It holds a
+# `_Mark`, never the traceback.
+REPORTED_ATTR = '__heka_raven_reported__'
+
 class InvalidArgumentError(RuntimeError): pass
 
-class RavenClient(Client):
-    """
-    Customized raven client that does not actually send data to a
-    server, but encodes the data into something heka can use
-    """
-    def capture(self, event_type, data=None, date=None, time_spent=None,
-                extra=None, stack=None, **kwargs):
-        """
-        Captures and processes an event and pipes it off to SentryClient.send.
-
-        To use structured data (interfaces) with capture:
-
-        >>> capture('Message', message='foo', data={
-        >>>     'sentry.interfaces.Http': {
-        >>>         'url': '...',
-        >>>         'data': {},
-        >>>         'query_string': '...',
-        >>>         'method': 'POST',
-        >>>     },
-        >>>     'logger': 'logger.name',
-        >>>     'site': 'site.name',
-        >>> }, extra={
-        >>>     'key': 'value',
-        >>> })
-
-        The finalized ``data`` structure contains the following (some optional)
-        builtin values:
-
-        >>> {
-        >>>     # the culprit and version information
-        >>>     'culprit': 'full.module.name', # or /arbitrary/path
-        >>>
-        >>>     # all detectable installed modules
-        >>>     'modules': {
-        >>>         'full.module.name': 'version string',
-        >>>     },
-        >>>
-        >>>     # arbitrary data provided by user
-        >>>     'extra': {
-        >>>         'key': 'value',
-        >>>     }
-        >>> }
-
-        :param event_type: the module path to the Event class. Builtins can use
-                           shorthand class notation and exclude the full module
-                           path.
-        :param data: the data base, useful for specifying structured data
-                           interfaces. Any key which contains a '.' will be
-                           assumed to be a data interface.
-        :param date: the datetime of this event
-        :param time_spent: a float value representing the duration of the event
-        :param event_id: a 32-length unique string identifying this event
-        :param extra: a dictionary of additional standard metadata
-        :param culprit: a string representing the cause of this event
-                        (generally a path to a function)
-        :return: a 32-length string identifying this event
-        """
-
-        data = self.build_msg(event_type, data, date, time_spent,
-                extra, stack, **kwargs)
-
-        if 'public_key' in data:
-            del data['public_key']
-
-        message = self.encode(data)
-
-        # The standard raven client normally sends data out here
-        return message
+
+class _Mark(object):
+    """
+    Left on a reported exception.  `capture_stack.heka_call` keeps it
+    in a local variable of its frame, which lives exactly as long as
+    the traceback the exception propagates with.  A mark left by a
+    direct call of the plugin, with no decorator frame to hold it,
+    instead records the identity of the traceback entries it was
+    reported with in `tb_ids`.
+    """
+    __slots__ = ('tb_ids',)
+
+    def __init__(self, tb_ids=None):
+        self.tb_ids = tb_ids
+
+
+def _tb_ids(tb):
+    ids = []
+    while tb is not None:
+        ids.append((id(tb), id(tb.tb_frame), tb.tb_lasti))
+        tb = tb.tb_next
+    return tuple(ids)
+
+
+def _mark_reported(exc_value, tb):
+    mark = _Mark(_tb_ids(tb))
+    try:
+        setattr(exc_value, REPORTED_ATTR, mark)
+    except (AttributeError, TypeError):
+        # Some builtin or extension exceptions do not take attributes.
+        pass
+    return mark
+
+
+def _is_reported(exc_value, tb):
+    """
+    Return True if `exc_value` was already reported while propagating
+    with the traceback `tb`.  The same instance raised again, such as
+    a module level sentinel, is reported again.
+    """
+    mark = getattr(exc_value, REPORTED_ATTR, None)
+    if mark is None:
+        return False
+    ids = []
+    while tb is not None:
+        frame = tb.tb_frame
+        if (frame.f_code is _HEKA_CALL_CODE and
+                frame.f_locals.get('reported') is mark):
+            return True
+        ids.append((id(tb), id(frame), tb.tb_lasti))
+        next_tb = tb.tb_next
+        # On Python 3 raising an instance again chains the new
+        # traceback onto its previous one: stop at the first frame
+        # which was not called by the one before it.  Generator
+        # frames forget their caller once they exit.
+        if next_tb is not None:
+            caller = next_tb.tb_frame.f_back
+            if caller is not None and caller is not frame:
+                break
+        tb = next_tb
+    tb_ids = mark.tb_ids
+    return bool(tb_ids) and tuple(ids[-len(tb_ids):]) == tb_ids
+
+
+def _report_error(e, exc_value):
+    """
+    Write a failure to capture `exc_value` to stderr, the way
+    `HekaClient.send_message` reports failures to send a message.  The
+    exception being reported must never be replaced by an error of the
+    plugin itself.
+    """
+    try:
+        err_msg = "Error capturing exception (%r): [%r]\n" % (e, exc_value)
+        sys.stderr.write(err_msg)
+    except Exception:
+        pass
+
+
+def _pop_float(config, key, default=None):
+    """
+    Pop a numeric option from the plugin configuration.  INI files
+    only give us integers for free, so floats arrive as strings.
+    """
+    value = config.pop(key, default)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise InvalidArgumentError("%s must be a number: %r" % (key, value))
+
+
+def _pop_int(config, key, default=None):
+    value = config.pop(key, default)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidArgumentError("%s must be an integer: %r" % (key, value))
+
+
+def _pop_list(config, key):
+    """
+    Pop a list of names from the plugin configuration.  Lists may be
+    given one per line in INI files, or comma separated.
+    """
+    value = config.pop(key, None)
+    if value is None:
+        return None
+    if isinstance(value, string_types):
+        value = value.split(',')
+    return [v.strip() for v in value if v.strip()]
+
+
+def get_client_module():
+    """
+    Return `heka_raven.client`, importing it, and raven with it, on
+    the first call.  `RavenClient` and `ExceptionEvent`, which used to
+    be defined in this module, are found there.
+    """
+    from heka_raven import client
+    return client
+
+
+class LazyRavenClient(object):
+    """
+    Import raven and build a `heka_raven.client.RavenClient` the first
+    time one is needed, so that processes which never capture an
+    exception do not pay for it.
+
+    :param builder: 'raven' (the default), or 'native' to build a
+                    `heka_raven.protocol.EventBuilder`, which does not
+                    import raven, instead
+    :param options: keyword arguments for `RavenClient`
+    """
+
+    def __init__(self, builder=RAVEN_BUILDER, **options):
+        self.builder = builder
+        self.options = options
+        self.client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the client, building it on the first call.  This is
+        thread safe, the client is only ever built once.
+        """
+        client = self.client
+        if client is not None:
+            return client
+
+        self._lock.acquire()
+        try:
+            if self.client is None:
+                if self.builder == NATIVE_BUILDER:
+                    from heka_raven.protocol import EventBuilder as cls
+                else:
+                    cls = get_client_module().RavenClient
+                client = cls(**self.options)
+                # Everything which is the same for every event is
+                # worked out once, here, so that capturing only pays
+                # for the stack itself.
+                client.refresh_static_data()
+                self.client = client
+            return self.client
+        finally:
+            self._lock.release()
+
+    def after_fork(self):
+        """
+        Make the client usable in a newly forked process.
+        """
+        self._lock = threading.Lock()
+        if self.client is not None:
+            self.client.after_fork()
+
+
+class ForkWatcher(object):
+    """
+    Call `callback` in child processes after a fork, so that state
+    inherited from the parent (threads, queues, buffers, counters and
+    locks) can be rebuilt.  Where `os.register_at_fork` is available
+    (Python 3.7+) this happens right after the fork, otherwise the
+    first time `check` is called in the child.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.pid = os.getpid()
+        if hasattr(os, 'register_at_fork'):
+            # Hooks cannot be unregistered, do not keep the watcher
+            # alive.
+            ref = weakref.ref(self)
+
+            def after_in_child():
+                watcher = ref()
+                if watcher is not None:
+                    watcher.check()
+            os.register_at_fork(after_in_child=after_in_child)
+
+    def check(self):
+        """
+        Call the callback if this process is not the one `check` was
+        last called from.
+        """
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.callback()
 
 
 class capture_stack(HekaDecorator):
@@ -98,25 +280,94 @@ class capture_stack(HekaDecorator):
     :param severity: The default severity of the error.  Default is 3 as
       defined by `heka.client:SEVERITY.ERROR`
       <https://github.com/mozilla-services/heka-py/blob/master/heka/client.py> # NOQA
+    :param logger: Optional logger name to use instead of the plugin's
+                   default logger.
+    :param exceptions: Optional exception class, or tuple of classes.
+                       Only exceptions of these classes are captured,
+                       anything else is re-raised untouched.
+    :param sample_rate: Optional rate, between 0 and 1, at which
+                        exceptions are captured.  The rate is recorded
+                        in the message's `sample_rate` field.
 
     The logger name will automatically be set the the fully qualified
     name of the decorated function.
 
+    An exception is only reported once: when it propagates through
+    several decorated functions, the outer ones skip it.  The same
+    instance raised again is reported again.
+
+    All options are resolved once, when the decorator is created, and
+    the plugin method is looked up on the heka client the first time
+    an exception is captured.  Calls which do not raise only pay for
+    `HekaDecorator.predicate` and a `try` block.
+
     """
 
-    def heka_call(self, *args, **kwargs):
-        if self.kwargs is None:
-            self.kwargs = {}
-        severity = self.kwargs.pop('severity', SEVERITY.ERROR)
+    def __init__(self, *args, **kwargs):
+        # These must be removed before HekaDecorator sees them, it
+        # JSON encodes its keyword arguments.
+        self.severity = kwargs.pop('severity', SEVERITY.ERROR)
+        self.logger = kwargs.pop('logger', None)
+        exceptions = kwargs.pop('exceptions', None)
+        if exceptions is None:
+            exceptions = BaseException
+        self.exceptions = exceptions
+        self.sample_rate = kwargs.pop('sample_rate', None)
+        self._plugin_fn = None
+        super(capture_stack, self).__init__(*args, **kwargs)
 
+    def heka_call(self, *args, **kwargs):
         try:
-            result = self._fn(*args, **kwargs)
-            return result
+            return self._fn(*args, **kwargs)
         except:
-            plugin_fn = getattr(self.client, HEKA_PLUGIN_NAME)
-            plugin_fn(severity=severity)
+            # Bare, so that old style class exceptions are caught too.
+            if (self.exceptions is BaseException or
+                    isinstance(sys.exc_info()[1], self.exceptions)):
+                # Held by this frame while the exception propagates,
+                # outer layers find it there, see `_is_reported`.
+                reported = self._capture()
             raise
 
+    def _capture(self):
+        """
+        Report the exception being handled unless an inner layer did,
+        and return the mark it carries.
+        """
+        exc_value, tb = sys.exc_info()[1:]
+        if _is_reported(exc_value, tb):
+            # Already reported, or sampled out, by an inner layer.
+            return getattr(exc_value, REPORTED_ATTR)
+
+        sample_rate = self.sample_rate
+        if sample_rate is not None and random.random() >= sample_rate:
+            return self._claim(_mark_reported(exc_value, tb))
+
+        plugin_fn = self._plugin_fn
+        if plugin_fn is None:
+            plugin_fn = self._plugin_fn = getattr(self.client,
+                                                  HEKA_PLUGIN_NAME)
+
+        options = {'severity': self.severity}
+        if self.logger is not None:
+            options['logger'] = self.logger
+        if sample_rate is not None:
+            options['sample_rate'] = sample_rate
+        try:
+            plugin_fn(**options)
+        except Exception as e:
+            _report_error(e, exc_value)
+        return self._claim(getattr(exc_value, REPORTED_ATTR, None))
+
+    def _claim(self, mark):
+        # From now on the mark is found in the frame of `heka_call`,
+        # the traceback entries it recorded are not needed.
+        if mark is not None:
+            mark.tb_ids = None
+        return mark
+
+
+_HEKA_CALL_CODE = capture_stack.__dict__['heka_call'].__code__
+
 
 def config_plugin(config):
     """
@@ -128,6 +379,146 @@ def config_plugin(config):
     :param severity: The default severity of the error.  Default is 3 as
       defined by `heka.client:SEVERITY.ERROR`
       <https://github.com/mozilla-services/heka-py/blob/master/heka/client.py> # NOQA
+    :param dedup_window: Enables deduplication of repeated exceptions.
+                         Number of seconds between "seen N times"
+                         summaries of suppressed repeats.
+    :param dedup_rate: Number of full captures per second allowed for
+                       a single exception fingerprint.  Defaults to one
+                       per `dedup_window`.
+    :param dedup_burst: Number of back to back full captures allowed
+                        for a single exception fingerprint.  Default
+                        is 1.
+    :param dedup_max_entries: Maximum number of fingerprints tracked at
+                              once.  Default is 1000.
+    :param async: Set to 'thread' to serialize and send exceptions on
+                  background worker threads.  By default exceptions
+                  are captured synchronously.
+    :param async_queue_size: Maximum number of exceptions waiting to be
+                             captured in the background.  Default is
+                             1000.
+    :param async_workers: Number of background worker threads.  Default
+                          is 1.
+    :param async_overflow: What to do when the queue is full: 'drop'
+                           (the default) or 'block'.
+    :param async_block_timeout: Maximum number of seconds to block for
+                                when `async_overflow` is 'block'.
+                                Blocks forever by default.
+    :param exit_timeout: Maximum number of seconds spent sending queued
+                         exceptions, pending summaries, the current
+                         batch and rollup when the process exits.
+                         Default is 5.
+    :param max_frames: Maximum number of stack frames captured.  Frames
+                       are dropped from the middle of deeper stacks.
+    :param max_locals: Maximum number of local variables captured per
+                       frame.
+    :param max_repr_length: Maximum length of captured strings and
+                            reprs.  Default is 400.
+    :param max_items: Maximum number of items captured per list, tuple,
+                      set or dict.  Default is 50.
+    :param max_depth: Maximum nesting of captured containers.  Default
+                      is 6.
+    :param include_vars: If set, only local variables with these names
+                         are captured.
+    :param exclude_vars: Local variables with these names are never
+                         captured.
+    :param encoding: How the sentry payload is encoded: 'raven' (the
+                     default), 'fast', 'json', 'stream' or 'envelope'.
+                     See `heka_raven.encoding`.
+    :param builder: What builds the sentry events: 'raven' (the
+                    default), raven's client, or 'native', which builds
+                    the same events without importing raven.  See
+                    `heka_raven.protocol`.
+    :param protocol: Layout of the sentry events: 'v3' (the default),
+                     what raven 3.4 sends, or 'v4', what current Sentry
+                     versions expect.  The 'envelope' encoding requires
+                     'v4'.
+    :param scrub: Set to True to mask passwords, tokens, card numbers
+                  and other secrets in frame variables, extra data,
+                  exception values and messages.  See
+                  `heka_raven.scrub`.
+    :param scrub_keys: Names of values to mask, in addition to the
+                       defaults.  Any name containing one of these,
+                       case insensitively, is masked.  Enables `scrub`.
+    :param scrub_patterns: Regular expressions, one per line, of
+                           secrets to mask wherever they appear in a
+                           string, in addition to card numbers.
+                           Enables `scrub`.
+    :param max_payload_size: Maximum size of the encoded sentry payload.
+                             Larger events are trimmed until they fit,
+                             or dropped.  By default there is no limit.
+    :param frame_cache_size: Number of source snippets and code objects
+                             whose details are cached between
+                             captures.  Default is 1000, 0 disables
+                             the caches.  See `heka_raven.frames`.
+    :param batch: Set to True to send events in 'sentry_batch' messages
+                  holding many events each.  See `heka_raven.batch`.
+    :param batch_size: Maximum number of events per batch.  Default is
+                       100.
+    :param batch_max_bytes: Maximum payload size of a batch, only
+                            exceeded by a single event too large on
+                            its own.  Default is 49152, below hekad's
+                            64 KiB message limit.
+    :param batch_latency: Maximum number of seconds an event waits
+                          before its batch is sent.  Default is 1.
+    :param sample_rate: Default rate, between 0 and 1, at which
+                        exceptions are captured.  Default is 1.
+    :param sample_severity: Sample rates by severity, as "severity:
+                            rate" pairs.
+    :param sample_loggers: Sample rates by logger name prefix, as
+                           "logger: rate" pairs.
+    :param sample_exceptions: Sample rates by exception class name, as
+                              "ExceptionClass: rate" pairs.
+    :param sample_keep_first: Number of exceptions of each class always
+                              captured every minute, regardless of the
+                              sample rates.
+    :param stats: Set to True to record timings, payload sizes and
+                  counts of captured, suppressed and dropped events.
+                  See `heka_raven.stats`.
+    :param stats_interval: Number of seconds between heka 'timer' and
+                           'counter' messages reporting the recorded
+                           stats.  By default nothing is sent.
+    :param stats_prefix: Prefix of the names of the stats messages.
+                         Default is 'heka_raven'.
+    :param spool_path: Directory of an on-disk spool which events are
+                       written to when the heka stream raises.  They
+                       are sent once the stream recovers.  See
+                       `heka_raven.spool`.
+    :param spool_segment_size: Size of the spool's segment files.
+                               Default is 1048576.
+    :param spool_max_bytes: Maximum size of the spool.  Default is
+                            67108864.
+    :param spool_retry_interval: Number of seconds between attempts to
+                                 send spooled events.  Default is 5.
+    :param spool_send_timeout: Number of seconds to wait for the heka
+                               stream before spooling an event.  0
+                               waits for as long as the stream
+                               blocks.  Default is 1.
+    :param spool_fsync: Set to True to fsync every spooled event.
+    :param route_loggers: DSNs to send exceptions to by logger name
+                          prefix, as "logger: dsn" pairs.  See
+                          `heka_raven.routing`.
+    :param route_exceptions: DSNs to send exceptions to by the module
+                             of the exception class, as "module: dsn"
+                             pairs.
+    :param route_tags: DSNs to send exceptions to by a tag of the
+                       current `heka_raven.context`, as "name=value:
+                       dsn" pairs.
+    :param rollup_exceptions: Names of exception classes which are
+                              only counted, never captured.  The
+                              counts are sent periodically in
+                              'sentry_rollup' messages.  See
+                              `heka_raven.rollup`.
+    :param rollup_loggers: Logger name prefixes whose exceptions are
+                           only counted, never captured.
+    :param rollup_interval: Number of seconds between rollups.  Default
+                            is 60.
+    :param rollup_top: Maximum number of (exception type, culprit,
+                       logger) entries per rollup.  Default is 100.
+    :param rollup_max_entries: Maximum number of entries counted at
+                               once.  Default is 10000.
+    :param warm_up: Set to True to import raven and build the raven
+                    clients when the plugin is configured.  By default
+                    this is done when the first exception is captured.
 
     """
 
@@ -138,15 +529,364 @@ def config_plugin(config):
     sentry_project_id = config.pop("sentry_project_id", None)
 
     sentry_dsn = config.pop("dsn", None)
+
+    dedup_window = _pop_float(config, 'dedup_window')
+    dedup_rate = _pop_float(config, 'dedup_rate')
+    dedup_burst = _pop_int(config, 'dedup_burst', 1)
+    dedup_max_entries = _pop_int(config, 'dedup_max_entries', 1000)
+
+    async_mode = config.pop('async', None)
+    async_queue_size = _pop_int(config, 'async_queue_size', 1000)
+    async_workers = _pop_int(config, 'async_workers', 1)
+    async_overflow = config.pop('async_overflow', 'drop')
+    async_block_timeout = _pop_float(config, 'async_block_timeout')
+    exit_timeout = _pop_float(config, 'exit_timeout', 5.0)
+
+    client_options = {
+        'max_frames': _pop_int(config, 'max_frames'),
+        'max_locals': _pop_int(config, 'max_locals'),
+        'max_depth': _pop_int(config, 'max_depth', MAX_DEPTH),
+        'string_max_length': _pop_int(config, 'max_repr_length'),
+        'list_max_length': _pop_int(config, 'max_items'),
+        'include_vars': _pop_list(config, 'include_vars'),
+        'exclude_vars': _pop_list(config, 'exclude_vars'),
+        'encoding': config.pop('encoding', RAVEN),
+        'max_payload_size': _pop_int(config, 'max_payload_size'),
+        'frame_cache_size': _pop_int(config, 'frame_cache_size',
+                                     CACHE_SIZE),
+        'protocol': config.pop('protocol', V3),
+    }
+    builder = config.pop('builder', RAVEN_BUILDER)
+
+    scrub = config.pop('scrub', False)
+    scrub_keys = _pop_list(config, 'scrub_keys')
+    scrub_patterns = config.pop('scrub_patterns', None)
+    if isinstance(scrub_patterns, string_types):
+        # Regular expressions may hold commas, only split lines.
+        scrub_patterns = scrub_patterns.splitlines()
+    if scrub_patterns is not None:
+        scrub_patterns = [p.strip() for p in scrub_patterns if p.strip()]
+    if scrub or scrub_keys or scrub_patterns:
+        try:
+            scrubber = Scrubber(keys=scrub_keys, patterns=scrub_patterns)
+        except re.error as e:
+            raise InvalidArgumentError("Invalid scrub pattern: %s" % e)
+    else:
+        scrubber = None
+    client_options['scrubber'] = scrubber
+
+    batch = config.pop('batch', False)
+    batch_size = _pop_int(config, 'batch_size', 100)
+    batch_max_bytes = _pop_int(config, 'batch_max_bytes', BATCH_MAX_BYTES)
+    batch_latency = _pop_float(config, 'batch_latency', 1.0)
+
+    spool_path = config.pop('spool_path', None)
+    spool_segment_size = _pop_int(config, 'spool_segment_size', 1048576)
+    spool_max_bytes = _pop_int(config, 'spool_max_bytes', 67108864)
+    spool_retry_interval = _pop_float(config, 'spool_retry_interval', 5.0)
+    spool_send_timeout = _pop_float(config, 'spool_send_timeout', 1.0)
+    spool_fsync = config.pop('spool_fsync', False)
+
+    sample_rate = _pop_float(config, 'sample_rate')
+    sample_keep_first = _pop_int(config, 'sample_keep_first', 0)
+    try:
+        sample_severity = parse_rates(config.pop('sample_severity', None),
+                                      key_type=int)
+        sample_loggers = parse_rates(config.pop('sample_loggers', None))
+        sample_exceptions = parse_rates(config.pop('sample_exceptions', None))
+    except ValueError as e:
+        raise InvalidArgumentError(str(e))
+
+    try:
+        route_loggers = parse_routes(config.pop('route_loggers', None))
+        route_exceptions = parse_routes(config.pop('route_exceptions', None))
+        route_tags = parse_routes(config.pop('route_tags', None))
+    except ValueError as e:
+        raise InvalidArgumentError(str(e))
+
+    rollup_exceptions = _pop_list(config, 'rollup_exceptions')
+    rollup_loggers = _pop_list(config, 'rollup_loggers')
+    rollup_interval = _pop_float(config, 'rollup_interval', 60.0)
+    rollup_top = _pop_int(config, 'rollup_top', 100)
+    rollup_max_entries = _pop_int(config, 'rollup_max_entries', 10000)
+
+    stats_interval = _pop_float(config, 'stats_interval')
+    stats_prefix = config.pop('stats_prefix', 'heka_raven')
+    if config.pop('stats', False) or stats_interval:
+        stats = Stats(prefix=stats_prefix)
+    else:
+        stats = None
+
+    warm_up = config.pop('warm_up', False)
+
     if len(config) > 0:
         raise InvalidArgumentError("Unexpected arguments: %s" % str(config.keys()))
 
+    try:
+        get_encoder(client_options['encoding'])
+    except ValueError as e:
+        raise InvalidArgumentError(str(e))
+    if builder not in BUILDERS:
+        raise InvalidArgumentError("Unknown builder: %r" % (builder,))
+    if client_options['protocol'] not in PROTOCOLS:
+        raise InvalidArgumentError("Unknown protocol: %r"
+                                   % (client_options['protocol'],))
+    if client_options['encoding'] == ENVELOPE and \
+            client_options['protocol'] == V3:
+        raise InvalidArgumentError("The %r encoding requires protocol = v4"
+                                   % ENVELOPE)
+
     if sentry_dsn:
-        rc = RavenClient(dsn=sentry_dsn)
+        client_options['dsn'] = sentry_dsn
     else:
         # This method of instantiation is deprecated. Please use the
         # dsn from now on.
-        rc = RavenClient(project=sentry_project_id)
+        client_options['project'] = sentry_project_id
+    lazy_client = LazyRavenClient(builder=builder, stats=stats,
+                                  **client_options)
+
+    if route_loggers or route_exceptions or route_tags:
+        try:
+            router = Router(sentry_dsn, logger_routes=route_loggers,
+                            exception_routes=route_exceptions,
+                            tag_routes=route_tags)
+        except ValueError as e:
+            raise InvalidArgumentError(str(e))
+        # One client per DSN, created up front so that looking one up
+        # never needs a lock.  Each is still only built when first
+        # used.
+        client_pool = {}
+        for dsn in router.dsns():
+            if dsn != sentry_dsn:
+                routed_options = dict(client_options, dsn=dsn)
+                routed_options.pop('project', None)
+                client_pool[dsn] = LazyRavenClient(builder=builder,
+                                                   stats=stats,
+                                                   **routed_options)
+    else:
+        router = None
+        client_pool = {}
+    client_pool[sentry_dsn] = lazy_client
+
+    if warm_up:
+        for pooled in client_pool.values():
+            pooled.get()
+
+    static_fields = {'dsn': sentry_dsn}
+    encoded_fields = {}
+    if client_options['encoding'] != RAVEN:
+        encoded_fields['encoding'] = client_options['encoding']
+    if client_options['protocol'] != V3:
+        encoded_fields['protocol'] = client_options['protocol']
+
+    # The heka client which last went through deduplication, pending
+    # summaries are sent through it from the timer and at exit.
+    summary_client = {}
+
+    def send_pending(key, count):
+        client = summary_client.get('client')
+        if client is not None:
+            dispatch(send_summary, client, key, count, '', default_logger,
+                     default_severity)
+
+    if dedup_window:
+        dedup = Deduplicator(dedup_window, rate=dedup_rate,
+                             burst=dedup_burst,
+                             max_entries=dedup_max_entries,
+                             send=send_pending)
+    else:
+        dedup = None
+
+    if async_mode == 'thread':
+        try:
+            dispatcher = ThreadDispatcher(queue_size=async_queue_size,
+                                          workers=async_workers,
+                                          overflow=async_overflow,
+                                          block_timeout=async_block_timeout)
+        except ValueError as e:
+            raise InvalidArgumentError(str(e))
+    elif async_mode:
+        raise InvalidArgumentError("Unsupported async mode: %r" % async_mode)
+    else:
+        dispatcher = None
+
+    if (sample_rate is not None or sample_severity or sample_loggers or
+            sample_exceptions or sample_keep_first):
+        if sample_rate is None:
+            sample_rate = 1.0
+        sampler = Sampler(default_rate=sample_rate,
+                          severity_rates=sample_severity,
+                          logger_rates=sample_loggers,
+                          exception_rates=sample_exceptions,
+                          keep_first=sample_keep_first)
+    else:
+        sampler = None
+
+    if spool_path:
+        spooler = SpoolingSender(Spool(spool_path,
+                                       segment_size=spool_segment_size,
+                                       max_bytes=spool_max_bytes,
+                                       fsync=spool_fsync),
+                                 retry_interval=spool_retry_interval,
+                                 send_timeout=spool_send_timeout,
+                                 stats=stats)
+        heka_send = spooler.heka
+    else:
+        spooler = None
+        heka_send = None
+
+    if batch:
+        batcher = Batcher(max_events=batch_size,
+                          max_bytes=batch_max_bytes,
+                          max_latency=batch_latency,
+                          fields=static_fields,
+                          send=heka_send)
+    else:
+        batcher = None
+
+    if rollup_exceptions or rollup_loggers:
+        try:
+            rollup = Rollup(exceptions=rollup_exceptions,
+                            loggers=rollup_loggers,
+                            interval=rollup_interval,
+                            top=rollup_top,
+                            max_entries=rollup_max_entries,
+                            fields=static_fields,
+                            send=heka_send)
+        except ValueError as e:
+            raise InvalidArgumentError(str(e))
+    else:
+        rollup = None
+
+    if stats is not None and stats_interval:
+        reporter = Reporter(stats, stats_interval, logger=default_logger)
+        atexit.register(reporter.stop)
+    else:
+        reporter = None
+
+    def after_fork():
+        for pooled in client_pool.values():
+            pooled.after_fork()
+        for component in (router, dedup, sampler, rollup, dispatcher,
+                          batcher, stats, reporter, spooler):
+            if component is not None:
+                component.after_fork()
+
+    fork_watcher = ForkWatcher(after_fork)
+
+    def scrub_field(text):
+        # The msg field is sent as is, outside of the sentry payload.
+        if scrubber is None or not isinstance(text, string_types):
+            return text
+        return scrubber.scrub(text)[0]
+
+    def dispatch(fn, *args):
+        if dispatcher is None:
+            fn(*args)
+        elif not dispatcher.submit(fn, *args) and stats is not None:
+            stats.incr('dropped')
+
+    def send(client, payload, logger, severity, fields):
+        if stats is not None:
+            start = clock()
+        if batcher is not None:
+            batcher.add(client, payload, logger, severity, fields,
+                        fields.get('dsn'))
+        elif spooler is not None:
+            spooler.heka(client, type='sentry',
+                    logger=logger,
+                    payload=payload,
+                    fields=fields,
+                    severity=severity)
+        else:
+            client.heka(type='sentry',
+                    logger=logger,
+                    payload=payload,
+                    fields=fields,
+                    severity=severity)
+        if stats is not None:
+            stats.timing('send', clock() - start)
+            stats.incr('sent')
+
+    def capture(client, exc_info, msg, logger, severity, fields,
+                context=None, chain=None):
+        annotations = {}
+        rc = client_pool.get(fields['dsn'], lazy_client).get()
+        extra = {'msg': msg,
+            'logger': logger,
+            'severity': severity}
+        if context is None:
+            options = {'extra': extra}
+        else:
+            options = capture_options(context, extra)
+        payload = rc.captureException(exc_info, annotations=annotations,
+                                      chain=chain, **options)
+        if payload is None:
+            # Too large to send even after trimming.
+            return
+        fields.update(annotations)
+        fields.update(encoded_fields)
+        send(client, payload, logger, severity, fields)
+
+    def send_summary(client, key, count, msg, logger, severity):
+        # Summaries go to the DSN the exception itself is routed to.
+        fp, dsn = key
+        exc_type, culprit, frames = fp
+        text = '%s in %s: seen %d times' % (exc_type, culprit, count)
+        rc = client_pool.get(dsn, lazy_client).get()
+        payload = rc.captureMessage(text, extra={'msg': msg,
+            'logger': logger,
+            'severity': severity})
+        if payload is None:
+            return
+        fields = dict(static_fields)
+        if dsn is not None:
+            fields['dsn'] = dsn
+        fields.update(encoded_fields)
+        fields['msg'] = scrub_field(msg)
+        fields['fingerprint'] = fingerprint_id(fp)
+        fields['seen'] = count
+        send(client, payload, logger, severity, fields)
+
+    def send_message(client, text, logger, severity, fields, context=None):
+        rc = client_pool.get(fields['dsn'], lazy_client).get()
+        extra = {'logger': logger, 'severity': severity}
+        if context is None:
+            options = {'extra': extra}
+        else:
+            options = capture_options(context, extra)
+        payload = rc.captureMessage(text, **options)
+        if payload is None:
+            return
+        fields.update(encoded_fields)
+        send(client, payload, logger, severity, fields)
+
+    def capture_message(client, text, logger=default_logger,
+            severity=default_severity, **kwargs):
+        """
+        Send `text` as a sentry message event, in the background when
+        `async` is enabled.  Sampling and deduplication only apply to
+        exceptions.  Extra keyword arguments are added to the message
+        fields.
+
+        :param client: the heka client to send the message through
+        """
+        fork_watcher.check()
+        fields = dict(static_fields)
+        fields['msg'] = scrub_field(text)
+        fields.update(kwargs)
+        context = get_current_context()
+        if context is not None:
+            context = context.snapshot()
+            if context['request_id'] is not None:
+                fields['request_id'] = context['request_id']
+        if router is not None:
+            fields['dsn'] = router.route(None, logger or client.logger,
+                                         context and context['tags'])
+        if stats is not None:
+            stats.incr('messages')
+        dispatch(send_message, client, text, logger, severity, fields,
+                 context)
 
     def heka_raven(self,
             msg='',
@@ -175,21 +915,161 @@ def config_plugin(config):
             # There is no exception
             return
 
-        if 'payload' not in kwargs:
-            payload = rc.captureException(exc_info, extra={'msg': msg,
-                'logger': logger,
-                'severity': severity})
-        else:
-            payload = kwargs.pop('payload')
+        fork_watcher.check()
+
+        if stats is not None:
+            if reporter is not None:
+                reporter.start(self)
+            start = clock()
+
+        exc_value = exc_info[1]
+        dsn = None
+        if 'payload' not in kwargs and exc_value is not None:
+            if _is_reported(exc_value, exc_info[2]):
+                if stats is not None:
+                    stats.timing('filter', clock() - start)
+                    stats.incr('already_reported')
+                return
+            _mark_reported(exc_value, exc_info[2])
+
+            if router is not None:
+                # Routed before filtering, so that rollups and summaries
+                # go to the same DSN as the events they stand for.
+                current = get_current_context()
+                dsn = router.route(exc_info[0], logger or self.logger,
+                                   current and current.tags)
+
+            if rollup is not None:
+                rollup_logger = logger or self.logger
+                if rollup.matches(exc_info[0], rollup_logger):
+                    rollup.add(self, rollup_key(exc_info, rollup_logger),
+                               severity, dsn)
+                    if stats is not None:
+                        stats.timing('filter', clock() - start)
+                        stats.incr('rolled_up')
+                    return
+
+        sample_rate = None
+        if 'payload' not in kwargs and sampler is not None:
+            sample_rate = sampler.sample(exc_info[0], logger or self.logger,
+                                         severity)
+            if sample_rate is None:
+                if stats is not None:
+                    stats.timing('filter', clock() - start)
+                    stats.incr('sampled_out')
+                return
 
-        fields = {'msg': msg,
-                  'dsn': sentry_dsn}
+        if 'payload' not in kwargs and dedup is not None:
+            summary_client['client'] = self
+            key = (fingerprint(exc_info), dsn)
+            verdict = dedup.check(key)
+            if verdict != CAPTURE:
+                if stats is not None:
+                    stats.timing('filter', clock() - start)
+                    stats.incr('suppressed')
+                if verdict != SUPPRESS:
+                    dispatch(send_summary, self, key, verdict, msg, logger,
+                             severity)
+                return
+
+        if stats is not None:
+            stats.timing('filter', clock() - start)
+            stats.incr('captured')
+
+        payload = kwargs.pop('payload', None)
+        fields = dict(static_fields)
+        fields['msg'] = scrub_field(msg)
+        upstream_rate = kwargs.pop('sample_rate', None)
+        if upstream_rate is not None:
+            if sample_rate is None:
+                sample_rate = upstream_rate
+            else:
+                sample_rate *= upstream_rate
+        if sample_rate is not None:
+            fields['sample_rate'] = float(sample_rate)
         fields.update(kwargs)
-        self.heka(type='sentry',
-                logger=logger,
-                payload=payload,
-                fields=fields,
-                severity=severity)
+
+        if payload is not None:
+            dispatch(send, self, payload, logger, severity, fields)
+            return
+
+        # The context is local to this thread or task, it is copied
+        # here so that it can be serialized on another thread.
+        context = get_current_context()
+        if context is not None:
+            context = context.snapshot()
+            if context['request_id'] is not None:
+                fields['request_id'] = context['request_id']
+
+        if dsn is not None:
+            fields['dsn'] = dsn
+
+        if dispatcher is None:
+            try:
+                capture(self, exc_info, msg, logger, severity, fields,
+                        context)
+            except Exception as e:
+                _report_error(e, exc_value)
+        else:
+            exc_info, chain = snapshot_chain(exc_info)
+            dispatch(capture, self, exc_info, msg, logger, severity, fields,
+                     context, chain)
+
+    def flush_summaries(client, msg='', logger=default_logger,
+            severity=default_severity):
+        """
+        Send "seen N times" summaries for every exception with
+        suppressed repeats which have not been reported yet.  This is
+        a no-op unless deduplication is enabled.
+
+        :param client: the heka client to send the summaries through
+        """
+        if dedup is None:
+            return
+        fork_watcher.check()
+        for key, count in dedup.drain():
+            dispatch(send_summary, client, key, count, msg, logger, severity)
+
+    def flush(timeout=None):
+        """
+        Wait for exceptions queued for background capture to be sent
+        and send any partially filled batch and the current rollup.
+        Returns False if `timeout` seconds elapsed first.  This always
+        succeeds immediately unless `async` or `batch` is enabled.
+        """
+        fork_watcher.check()
+        flushed = True
+        if dispatcher is not None:
+            flushed = dispatcher.flush(timeout)
+        if batcher is not None:
+            batcher.flush()
+        if rollup is not None:
+            rollup.flush()
+        return flushed
+
+    def flush_at_exit():
+        if 'client' in summary_client:
+            flush_summaries(summary_client['client'])
+        flush(exit_timeout)
+
+    if (dispatcher is not None or batcher is not None or
+            rollup is not None or dedup is not None):
+        atexit.register(flush_at_exit)
 
     heka_raven.heka_name = HEKA_PLUGIN_NAME
+    heka_raven.lazy_client = lazy_client
+    heka_raven.client_pool = client_pool
+    heka_raven.router = router
+    heka_raven.dedup = dedup
+    heka_raven.sampler = sampler
+    heka_raven.rollup = rollup
+    heka_raven.flush_summaries = flush_summaries
+    heka_raven.capture_message = capture_message
+    heka_raven.dispatcher = dispatcher
+    heka_raven.batcher = batcher
+    heka_raven.flush = flush
+    heka_raven.stats = stats
+    heka_raven.spooler = spooler
+    heka_raven.fork_watcher = fork_watcher
     return heka_raven
+
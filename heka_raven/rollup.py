@@ -0,0 +1,265 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Periodic rollups of known, noisy exceptions.
+
+Exceptions selected for rolling up are never captured: no stack is
+walked and nothing is serialized.  They are counted per (exception
+type, culprit, logger) and, every `interval` seconds, the most
+frequent entries are sent as a single heka message of type
+'sentry_rollup'.  Its payload is a JSON document::
+
+    {"version": 1,
+     "start": 1385729541.123,
+     "end": 1385729601.123,
+     "entries": [{"type": "KeyError",
+                  "culprit": "myapp.cache in get",
+                  "logger": "myapp",
+                  "count": 1234,
+                  "first_seen": 1385729541.5,
+                  "last_seen": 1385729600.9},
+                 ...],
+     "omitted_entries": 0,
+     "omitted_count": 0}
+
+Exceptions routed to a DSN other than the default one are sent in a
+rollup of their own, whose heka message has that `dsn` field.
+
+Entries are sorted by decreasing count.  Entries beyond the `top` most
+frequent ones are only counted in "omitted_entries" and
+"omitted_count", and exceptions which would have started a new entry
+while the table was full only in "omitted_count".  The heka message
+carries a `count` field with the number of exceptions rolled up and a
+`distinct` field with the number of entries.
+"""
+
+import functools
+import heapq
+import json
+import threading
+import time
+
+ROLLUP_TYPE = 'sentry_rollup'
+ENVELOPE_VERSION = 1
+
+# Indexes into the entries of `Rollup`
+_COUNT, _FIRST, _LAST, _SEVERITY = 0, 1, 2, 3
+
+
+def rollup_key(exc_info, logger):
+    """
+    Return the (exception type name, culprit, logger) an exception is
+    counted under.  The culprit is the innermost frame of the
+    traceback, in raven's "module in function" format.
+    """
+    exc_type, exc_value, tb = exc_info
+    culprit = ''
+    if tb is not None:
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        frame = tb.tb_frame
+        culprit = '%s in %s' % (frame.f_globals.get('__name__') or '?',
+                                frame.f_code.co_name)
+    return (getattr(exc_type, '__name__', '<unknown>'), culprit,
+            logger or '')
+
+
+def decode_rollup(payload):
+    """
+    Return the document held by the payload of a 'sentry_rollup'
+    message.
+    """
+    envelope = json.loads(payload)
+    version = envelope.get('version')
+    if version != ENVELOPE_VERSION:
+        raise ValueError("Unsupported rollup version: %r" % (version,))
+    return envelope
+
+
+class Rollup(object):
+    """
+    Counts exceptions of the configured classes or loggers and sends
+    the counts every `interval` seconds.
+
+    :param exceptions: names, or fully qualified names, of the
+                       exception classes rolled up.  Subclasses are
+                       rolled up too.
+    :param loggers: logger name prefixes whose exceptions are rolled up
+    :param interval: number of seconds between rollups
+    :param top: maximum number of entries sent per rollup
+    :param max_entries: maximum number of entries counted at once
+    :param fields: fields added to every rollup message
+    :param send: optional function called as `send(client, type=...,
+                 logger=..., payload=..., fields=..., severity=...)`
+                 to send a rollup instead of `client.heka`
+    """
+
+    def __init__(self, exceptions=None, loggers=None, interval=60.0,
+                 top=100, max_entries=10000, fields=None, send=None,
+                 clock=time.time):
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.exceptions = frozenset(exceptions or ())
+        self.loggers = tuple(loggers or ())
+        self.interval = interval
+        self.top = top
+        self.max_entries = max_entries
+        self.fields = fields or {}
+        self.send = send
+        self.clock = clock
+        self._matches = {}
+        self.after_fork()
+
+    def after_fork(self):
+        """
+        Forget the counts inherited from the parent process, which
+        still sends them.
+        """
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._omitted = {}
+        self._start = None
+        self._client = None
+        self._timer = None
+
+    def matches(self, exc_type, logger):
+        """
+        Return True if exceptions of class `exc_type` reported through
+        `logger` are rolled up.
+        """
+        key = (exc_type, logger)
+        try:
+            return self._matches[key]
+        except KeyError:
+            pass
+
+        matched = False
+        if self.exceptions:
+            for cls in getattr(exc_type, '__mro__', (exc_type,)):
+                name = getattr(cls, '__name__', None)
+                qualified = '%s.%s' % (getattr(cls, '__module__', ''), name)
+                if name in self.exceptions or qualified in self.exceptions:
+                    matched = True
+                    break
+        if not matched and logger:
+            for prefix in self.loggers:
+                if logger == prefix or logger.startswith(prefix + '.'):
+                    matched = True
+                    break
+
+        if len(self._matches) >= 1000:
+            self._matches.clear()
+        self._matches[key] = matched
+        return matched
+
+    def add(self, client, key, severity=None, dsn=None):
+        """
+        Count an occurrence of `key`, as returned by `rollup_key`.  The
+        rollup is sent through `client`.
+
+        :param dsn: DSN the exception is routed to, when not the
+                    default one
+        """
+        key = (dsn, key)
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            self._client = client
+            if self._start is None:
+                self._start = now
+                if self._timer is None:
+                    self._timer = threading.Timer(self.interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[_COUNT] += 1
+                entry[_LAST] = now
+                if severity is not None and (entry[_SEVERITY] is None or
+                                             severity < entry[_SEVERITY]):
+                    entry[_SEVERITY] = severity
+            elif len(self._entries) < self.max_entries:
+                self._entries[key] = [1, now, now, severity]
+            else:
+                self._omitted[dsn] = self._omitted.get(dsn, 0) + 1
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        Send the current rollup, if anything was counted, as one
+        message per DSN.  Returns the number of entries sent.
+        """
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            entries, self._entries = self._entries, {}
+            omitted, self._omitted = self._omitted, {}
+            start, self._start = self._start, None
+            client = self._client
+            timer, self._timer = self._timer, None
+        finally:
+            self._lock.release()
+
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+
+        by_dsn = dict((dsn, {}) for dsn in omitted)
+        for (dsn, key), entry in entries.items():
+            by_dsn.setdefault(dsn, {})[key] = entry
+
+        sent = 0
+        for dsn in sorted(by_dsn, key=lambda dsn: dsn or ''):
+            sent += self._send(client, dsn, by_dsn[dsn],
+                               omitted.get(dsn, 0), start, now)
+        return sent
+
+    def _send(self, client, dsn, entries, omitted, start, now):
+        total = omitted
+        severities = []
+        for entry in entries.values():
+            total += entry[_COUNT]
+            if entry[_SEVERITY] is not None:
+                severities.append(entry[_SEVERITY])
+
+        top = heapq.nlargest(self.top, entries.items(),
+                             key=lambda item: item[1][_COUNT])
+        kept = 0
+        rendered = []
+        for (exc_type, culprit, logger), entry in top:
+            kept += entry[_COUNT]
+            rendered.append({'type': exc_type,
+                             'culprit': culprit,
+                             'logger': logger,
+                             'count': entry[_COUNT],
+                             'first_seen': entry[_FIRST],
+                             'last_seen': entry[_LAST]})
+
+        payload = json.dumps({'version': ENVELOPE_VERSION,
+                              'start': start,
+                              'end': now,
+                              'entries': rendered,
+                              'omitted_entries': len(entries) - len(top),
+                              'omitted_count': total - kept},
+                             separators=(',', ':'))
+
+        fields = dict(self.fields)
+        if dsn is not None:
+            fields['dsn'] = dsn
+        fields['count'] = total
+        fields['distinct'] = len(entries)
+        if self.send is not None:
+            send = functools.partial(self.send, client)
+        else:
+            send = client.heka
+        send(type=ROLLUP_TYPE,
+             logger=None,
+             payload=payload,
+             fields=fields,
+             severity=min(severities) if severities else None)
+        return len(rendered)
@@ -0,0 +1,142 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Routing of captured exceptions to sentry DSNs.
+
+The DSN an exception is sent to is taken from the most specific rule
+that matches it:
+
+1. a tag of the current `heka_raven.context`, as "name=value"
+2. the longest matching dotted prefix of the exception class's module
+3. the longest matching dotted prefix of the logger name
+4. the default DSN
+
+Prefix rules are held in dicts, so a lookup costs one dict access per
+component of the dotted name, and results are remembered per
+(exception class, logger) pair.
+"""
+
+import threading
+
+from heka_raven.protocol import to_text
+
+
+def parse_routes(value):
+    """
+    Parse a mapping of names to DSNs.  `value` may be a dict, a list
+    of "name: dsn" strings (one per line in INI files) or a single
+    string of comma separated "name: dsn" pairs.
+    """
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        items = value.items()
+    else:
+        if not isinstance(value, (list, tuple)):
+            value = str(value).split(',')
+        items = []
+        for item in value:
+            item = item.strip()
+            if not item:
+                continue
+            # DSNs hold colons, names do not.
+            name, sep, dsn = item.partition(':')
+            if not sep or not dsn.strip():
+                raise ValueError("Expected 'name: dsn', got %r" % item)
+            items.append((name, dsn))
+    return dict((name.strip(), dsn.strip()) for name, dsn in items)
+
+
+def _match_prefix(routes, name):
+    while name:
+        dsn = routes.get(name)
+        if dsn is not None:
+            return dsn
+        name = name.rpartition('.')[0]
+    return None
+
+
+class Router(object):
+    """
+    Pick the DSN an exception is sent to.
+
+    :param default: DSN used when no rule matches
+    :param logger_routes: dict of logger name prefix to DSN
+    :param exception_routes: dict of exception module prefix to DSN
+    :param tag_routes: dict of "name=value" tag to DSN
+    :param max_entries: number of (exception class, logger) pairs
+                        whose DSN is remembered
+    """
+
+    def __init__(self, default=None, logger_routes=None,
+                 exception_routes=None, tag_routes=None, max_entries=1000):
+        self.default = default
+        self.logger_routes = dict(logger_routes or {})
+        self.exception_routes = dict(exception_routes or {})
+        self.tag_routes = {}
+        for tag, dsn in (tag_routes or {}).items():
+            name, sep, value = tag.partition('=')
+            if not sep:
+                raise ValueError("Expected 'name=value' tag, got %r" % tag)
+            self.tag_routes[(to_text(name.strip()),
+                             to_text(value.strip()))] = dsn
+        self.max_entries = max_entries
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        """
+        Replace the lock inherited from the parent process, which may
+        have been held by another thread when it forked.
+        """
+        self._lock = threading.Lock()
+
+    def dsns(self):
+        """
+        Return the set of DSNs exceptions may be sent to.
+        """
+        dsns = set([self.default])
+        for routes in (self.logger_routes, self.exception_routes,
+                       self.tag_routes):
+            dsns.update(routes.values())
+        return dsns
+
+    def route(self, exc_type, logger, tags=None):
+        """
+        Return the DSN for an exception of class `exc_type` reported
+        through `logger` while `tags` were set.
+        """
+        if self.tag_routes and tags:
+            for name, value in sorted(tags.items()):
+                dsn = self.tag_routes.get((to_text(name), to_text(value)))
+                if dsn is not None:
+                    return dsn
+
+        key = (exc_type, logger)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        dsn = None
+        if self.exception_routes and exc_type is not None:
+            dsn = _match_prefix(self.exception_routes,
+                                getattr(exc_type, '__module__', None))
+        if dsn is None and logger:
+            dsn = _match_prefix(self.logger_routes, logger)
+        if dsn is None:
+            dsn = self.default
+
+        self._lock.acquire()
+        try:
+            if len(self._cache) >= self.max_entries:
+                self._cache.clear()
+            self._cache[key] = dsn
+        finally:
+            self._lock.release()
+        return dsn
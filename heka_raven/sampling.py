@@ -0,0 +1,165 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Sampling of captured exceptions.
+
+The rate applied to an exception is taken from the most specific rule
+that matches it:
+
+1. the exception class, or any of its base classes, by name
+   (`KeyError`) or fully qualified name (`exceptions.KeyError`)
+2. the longest matching dotted prefix of the logger name
+3. the severity
+4. the default rate
+
+Independently of the rates, the first `keep_first` exceptions of each
+class every minute are always kept.
+"""
+
+import random
+import threading
+import time
+
+
+def parse_rates(value, key_type=str):
+    """
+    Parse a mapping of names to sample rates.  `value` may be a dict,
+    a list of "name: rate" strings (one per line in INI files) or a
+    single string of comma separated "name: rate" pairs.
+    """
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        items = value.items()
+    else:
+        if not isinstance(value, (list, tuple)):
+            value = str(value).split(',')
+        items = []
+        for item in value:
+            item = item.strip()
+            if not item:
+                continue
+            name, sep, rate = item.rpartition(':')
+            if not sep:
+                raise ValueError("Expected 'name: rate', got %r" % item)
+            items.append((name.strip(), rate))
+
+    rates = {}
+    for name, rate in items:
+        rate = float(rate)
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError("Sample rate for %r must be between 0 and 1"
+                             % (name,))
+        rates[key_type(name)] = rate
+    return rates
+
+
+class Sampler(object):
+    """
+    Decide whether an exception is captured, and at what rate.
+
+    :param default_rate: rate applied when no other rule matches
+    :param severity_rates: dict of severity to rate
+    :param logger_rates: dict of logger name prefix to rate
+    :param exception_rates: dict of exception class name to rate
+    :param keep_first: number of exceptions of each class kept every
+                       minute regardless of rates
+    """
+
+    def __init__(self, default_rate=1.0, severity_rates=None,
+                 logger_rates=None, exception_rates=None, keep_first=0,
+                 random=random.random, clock=time.time):
+        self.default_rate = default_rate
+        self.severity_rates = severity_rates or {}
+        self.exception_rates = exception_rates or {}
+        # Longest prefixes first so that the first match is the most
+        # specific one.
+        self.logger_rates = sorted((logger_rates or {}).items(),
+                                   key=lambda item: -len(item[0]))
+        self.keep_first = keep_first
+        self.random = random
+        self.clock = clock
+
+        self._exception_cache = {}
+        self._kept = {}
+        self._minute = None
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        """
+        Reset the per minute counts of a child process.
+        """
+        self._kept = {}
+        self._minute = None
+        self._lock = threading.Lock()
+
+    def rate_for(self, exc_type, logger, severity):
+        """
+        Return the sample rate which applies to an exception.
+        """
+        if self.exception_rates and exc_type is not None:
+            rate = self._exception_rate(exc_type)
+            if rate is not None:
+                return rate
+
+        if logger:
+            for prefix, rate in self.logger_rates:
+                if logger == prefix or logger.startswith(prefix + '.'):
+                    return rate
+
+        return self.severity_rates.get(severity, self.default_rate)
+
+    def _exception_rate(self, exc_type):
+        try:
+            return self._exception_cache[exc_type]
+        except KeyError:
+            pass
+
+        rate = None
+        for cls in getattr(exc_type, '__mro__', (exc_type,)):
+            name = getattr(cls, '__name__', None)
+            qualified = '%s.%s' % (getattr(cls, '__module__', ''), name)
+            for key in (qualified, name):
+                if key in self.exception_rates:
+                    rate = self.exception_rates[key]
+                    break
+            if rate is not None:
+                break
+
+        self._exception_cache[exc_type] = rate
+        return rate
+
+    def _keep(self, exc_type):
+        minute = int(self.clock() // 60)
+        self._lock.acquire()
+        try:
+            if minute != self._minute:
+                self._minute = minute
+                self._kept.clear()
+            kept = self._kept.get(exc_type, 0)
+            if kept >= self.keep_first:
+                return False
+            self._kept[exc_type] = kept + 1
+            return True
+        finally:
+            self._lock.release()
+
+    def sample(self, exc_type, logger, severity):
+        """
+        Returns the rate the exception was sampled at if it should be
+        captured, or None if it should be dropped.
+        """
+        if self.keep_first and self._keep(exc_type):
+            return 1.0
+
+        rate = self.rate_for(exc_type, logger, severity)
+        if rate >= 1.0:
+            return rate
+        if rate <= 0.0 or self.random() >= rate:
+            return None
+        return rate
@@ -0,0 +1,148 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Scrubbing of secrets from captured events.
+
+A `Scrubber` is applied by `heka_raven.serializer.VarsSerializer`
+while frame variables and extra data are serialized, rather than by
+walking the finished event again:
+
+1. the value of any variable, dict key or extra whose name contains
+   one of the denied `keys` (case insensitive) is replaced by `MASK`
+   without being serialized at all
+2. strings which are a card number are replaced by `MASK`, and the
+   parts of strings, and of reprs, matching one of the `patterns` too
+3. strings are then cut to the serializer's `max_repr_length`
+
+The HTTP request attached to an event is scrubbed with `scrub_http`.
+
+The keys and patterns are each compiled into a single regular
+expression, and the verdict for every key name is cached, so the cost
+per value is one regex substitution.
+"""
+
+import re
+
+from heka_raven.serializer import string_types
+
+MASK = '*' * 8
+
+# Case insensitive substrings of the names of sensitive values.
+DEFAULT_KEYS = ('password', 'passwd', 'secret', 'authorization', 'token',
+                'api_key', 'apikey', 'credentials', 'private_key', 'cookie')
+
+# Credit card numbers: 13 to 16 digits, optionally separated by spaces
+# or dashes.  Anchored like raven's `SanitizePasswordsProcessor`, so
+# that timestamps, order ids and phone numbers inside longer strings
+# are left alone.
+DEFAULT_PATTERNS = (r'^(?:\d[ -]*?){13,16}$',)
+
+# Parts of the `sentry.interfaces.Http` interface which may hold secrets.
+HTTP_FIELDS = ('data', 'cookies', 'headers', 'env', 'query_string')
+
+# Number of key names whose verdict is remembered.
+MAX_KEYS = 10000
+
+
+class Scrubber(object):
+    """
+    Masks sensitive values.
+
+    :param keys: substrings of the names of values always masked, in
+                 addition to `DEFAULT_KEYS`
+    :param patterns: regular expressions of secrets masked wherever
+                     they appear in a string, in addition to
+                     `DEFAULT_PATTERNS`
+    :param mask: replacement of masked values
+    """
+
+    def __init__(self, keys=None, patterns=None, mask=MASK):
+        self.keys = tuple(DEFAULT_KEYS) + tuple(keys or ())
+        self.patterns = tuple(DEFAULT_PATTERNS) + tuple(patterns or ())
+        self.mask = mask
+        self._keys_re = re.compile(
+            '|'.join(re.escape(key.lower()) for key in self.keys))
+        self._values_re = re.compile(
+            '|'.join('(?:%s)' % pattern for pattern in self.patterns))
+        self._verdicts = {}
+
+    def sensitive_key(self, key):
+        """
+        Return True if the value named `key` must be masked.
+        """
+        try:
+            return self._verdicts[key]
+        except (KeyError, TypeError):
+            pass
+        if not isinstance(key, string_types):
+            return False
+        verdict = self._keys_re.search(key.lower()) is not None
+        if len(self._verdicts) >= MAX_KEYS:
+            self._verdicts.clear()
+        self._verdicts[key] = verdict
+        return verdict
+
+    def scrub(self, text):
+        """
+        Mask the secrets found in the string `text`.  Returns the
+        scrubbed text and the number of secrets masked.
+        """
+        return self._values_re.subn(self.mask, text)
+
+    def scrub_http(self, http):
+        """
+        Mask the secrets found in the body, cookies, headers,
+        environment and query string of a `sentry.interfaces.Http`
+        dict, in place, the way raven's `SanitizePasswordsProcessor`
+        does.  Returns the number of values masked.
+        """
+        count = 0
+        for name in HTTP_FIELDS:
+            value = http.get(name)
+            if value is None:
+                continue
+            if (isinstance(value, string_types) and '=' in value and
+                    not self.sensitive_key(name)):
+                http[name], scrubbed = self._scrub_query(value)
+            else:
+                http[name], scrubbed = self._scrub_value(name, value)
+            count += scrubbed
+        return count
+
+    def _scrub_query(self, text):
+        count = 0
+        bits = []
+        for bit in text.split('&'):
+            chunk = bit.split('=')
+            if len(chunk) == 2:
+                value, scrubbed = self._scrub_value(chunk[0], chunk[1])
+                chunk = (chunk[0], value)
+                count += scrubbed
+            bits.append('='.join(chunk))
+        return '&'.join(bits), count
+
+    def _scrub_value(self, key, value):
+        if self.sensitive_key(key):
+            return self.mask, 1
+        if isinstance(value, string_types):
+            return self.scrub(value)
+        count = 0
+        if isinstance(value, dict):
+            result = {}
+            for k, v in value.items():
+                result[k], scrubbed = self._scrub_value(k, v)
+                count += scrubbed
+            return result, count
+        if isinstance(value, (list, tuple)):
+            result = []
+            for v in value:
+                v, scrubbed = self._scrub_value(None, v)
+                result.append(v)
+                count += scrubbed
+            return type(value)(result), count
+        return value, 0
@@ -0,0 +1,235 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Bounded serialization of stack frame variables.
+
+The output format matches raven's own serializers (strings are
+rendered as their repr, sequences become tuples, dict keys are
+serialized like values) so sentry renders the variables exactly as it
+always has.  Unlike raven, every step is bounded: containers are cut
+off after `max_items` entries, containers nested deeper than
+`max_depth` are summarized rather than repr'd in full, and arbitrary
+objects have their repr truncated to `max_repr_length`.
+
+Given a `heka_raven.scrub.Scrubber`, secrets are masked in the same
+pass.
+"""
+
+from uuid import UUID
+import sys
+
+PY3 = sys.version_info[0] == 3
+
+if PY3:
+    text_type = str
+    binary_type = bytes
+    string_types = (str,)
+    integer_types = (int,)
+else:
+    text_type = unicode  # NOQA
+    binary_type = str
+    string_types = (basestring,)  # NOQA
+    integer_types = (int, long)  # NOQA
+
+# Same defaults as raven.conf.defaults
+MAX_ITEMS = 50
+MAX_REPR_LENGTH = 400
+MAX_DEPTH = 6
+
+_TEXT_FORMAT = repr(text_type('%s'))
+_SEQUENCE_TYPES = (tuple, list, set, frozenset)
+
+
+def _has_sentry_metadata(value):
+    try:
+        return callable(value.__getattribute__('__sentry__'))
+    except Exception:
+        return False
+
+
+class VarsSerializer(object):
+    """
+    Serializes the local variables of stack frames, keeping count of
+    everything it had to leave out.  A new instance should be used for
+    every captured event.
+
+    :param max_locals: maximum number of variables serialized per frame
+    :param max_items: maximum number of items serialized per container
+    :param max_repr_length: maximum length of serialized strings
+    :param max_depth: maximum nesting of serialized containers
+    :param include_vars: if given, only variables with these names are
+                         serialized
+    :param exclude_vars: variables with these names are never
+                         serialized
+    :param scrubber: optional `heka_raven.scrub.Scrubber` masking
+                     sensitive values, before they are truncated
+    """
+
+    def __init__(self, max_locals=None, max_items=MAX_ITEMS,
+                 max_repr_length=MAX_REPR_LENGTH, max_depth=MAX_DEPTH,
+                 include_vars=None, exclude_vars=None, scrubber=None):
+        self.max_locals = max_locals
+        self.max_items = max_items
+        self.max_repr_length = max_repr_length
+        self.max_depth = max_depth
+        self.include_vars = include_vars
+        self.exclude_vars = exclude_vars
+        self.scrubber = scrubber
+
+        self.vars_omitted = 0
+        self.values_truncated = 0
+        self.values_scrubbed = 0
+        self._context = set()
+
+    def transform_locals(self, f_locals):
+        """
+        Serialize the variables of a single frame.  This is suitable
+        for use as the `transformer` of `raven.utils.stacks.get_stack_info`.
+        """
+        if not isinstance(f_locals, dict):
+            return self.transform(f_locals)
+
+        names = list(f_locals)
+        if self.include_vars is not None:
+            names = [n for n in names if n in self.include_vars]
+        if self.exclude_vars:
+            names = [n for n in names if n not in self.exclude_vars]
+        self.vars_omitted += len(f_locals) - len(names)
+
+        if self.max_locals is not None and len(names) > self.max_locals:
+            names.sort()
+            self.vars_omitted += len(names) - self.max_locals
+            names = names[:self.max_locals]
+
+        scrubber = self.scrubber
+        result = {}
+        for name in names:
+            key = self.transform(name, 1)
+            if not isinstance(key, string_types):
+                key = text_type(key)
+            if scrubber is not None and scrubber.sensitive_key(name):
+                self.values_scrubbed += 1
+                result[key] = scrubber.mask
+            else:
+                result[key] = self.transform(f_locals[name], 1)
+        return result
+
+    def transform(self, value, _depth=0):
+        """
+        Coerce `value` into something JSON serializable.
+        """
+        if value is None:
+            return None
+
+        objid = id(value)
+        if objid in self._context:
+            return '<...>'
+        self._context.add(objid)
+        try:
+            try:
+                return self._transform(value, _depth)
+            except Exception:
+                return text_type(type(value))
+        finally:
+            self._context.remove(objid)
+
+    def _transform(self, value, depth):
+        if isinstance(value, _SEQUENCE_TYPES):
+            if depth >= self.max_depth:
+                return self._summarize(value)
+            return tuple(self.transform(v, depth + 1)
+                         for v in self._take(value))
+
+        if isinstance(value, UUID):
+            return repr(value)
+
+        if isinstance(value, dict):
+            if depth >= self.max_depth:
+                return self._summarize(value)
+            scrubber = self.scrubber
+            result = {}
+            items = getattr(value, 'iteritems', value.items)()
+            for k, v in self._take(items):
+                key = self.transform(k, depth + 1)
+                if not isinstance(key, string_types):
+                    key = text_type(key)
+                if scrubber is not None and scrubber.sensitive_key(k):
+                    self.values_scrubbed += 1
+                    result[key] = scrubber.mask
+                else:
+                    result[key] = self.transform(v, depth + 1)
+            return result
+
+        if isinstance(value, text_type):
+            if self.scrubber is not None:
+                value = self._scrub(value)
+            return _TEXT_FORMAT % (self._truncate(value),)
+
+        if isinstance(value, binary_type):
+            if not PY3:
+                try:
+                    text = value.decode('utf8')
+                except UnicodeDecodeError:
+                    pass
+                else:
+                    if self.scrubber is not None:
+                        text = self._scrub(text)
+                    return "'" + self._truncate(text).encode('utf8') + "'"
+            if self.scrubber is not None:
+                # latin-1 maps every byte to a character and back.
+                value = self._scrub(value.decode('latin-1')).encode('latin-1')
+            return repr(self._truncate(value))
+
+        if isinstance(value, bool):
+            return bool(value)
+        if isinstance(value, float):
+            return float(value)
+        if isinstance(value, integer_types):
+            return value
+
+        if not isinstance(value, type) and _has_sentry_metadata(value):
+            return self.transform(value.__sentry__(), depth)
+
+        try:
+            text = repr(value)
+            if self.scrubber is not None:
+                text = self._scrub(text)
+            return self._truncate(text)
+        except Exception:
+            return text_type(type(value))
+
+    def _scrub(self, text):
+        text, count = self.scrubber.scrub(text)
+        self.values_scrubbed += count
+        return text
+
+    def _take(self, iterable):
+        """
+        Iterate over at most `max_items` items of a container.
+        """
+        limit = self.max_items
+        for i, item in enumerate(iterable):
+            if limit is not None and i >= limit:
+                self.values_truncated += 1
+                return
+            yield item
+
+    def _truncate(self, value):
+        limit = self.max_repr_length
+        if limit is not None and len(value) > limit:
+            self.values_truncated += 1
+            return value[:limit]
+        return value
+
+    def _summarize(self, value):
+        self.values_truncated += 1
+        try:
+            size = len(value)
+        except Exception:
+            size = '?'
+        return '<%s of %s items>' % (type(value).__name__, size)
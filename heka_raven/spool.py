@@ -0,0 +1,594 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+On-disk spool for messages the heka stream could not accept.
+
+Encoded heka messages are appended to segment files in a directory.
+Each record is framed with a header holding a magic number, the length
+of the message and its CRC32, so a record torn by a crash is detected
+and skipped when the segment is read back::
+
+    b'HRS1' | length (4 bytes, big endian) | crc32 (4 bytes) | message
+
+A segment is closed once it reaches `segment_size` bytes and a new one
+is started.  Nothing is written once the spool holds `max_bytes`
+bytes.  Records are replayed to the stream by a `Replayer`, oldest
+first, and a segment is deleted once every record in it was sent.
+Delivery is at least once: records of a partially replayed segment
+are sent again if the process dies before the segment is deleted.
+
+Processes forked from the one which created the spool each write to a
+subdirectory named after their pid.  The segments left in the
+subdirectory of a process which is no longer running are adopted, and
+replayed, by the next process to fork.
+"""
+
+from heka.message_pb2 import Message
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+import errno
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+MAGIC = b'HRS1'
+HEADER = struct.Struct('>4sII')
+SEGMENT_PREFIX = 'spool-'
+SEGMENT_SUFFIX = '.seg'
+
+log = logging.getLogger('heka_raven')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def encode_message(client, type, logger=None, severity=None, payload='',
+                   fields=None):
+    """
+    Build and encode a heka message the way `HekaClient.heka` does,
+    applying the client's filters.  Returns the bytes to write to the
+    stream, or None if a filter rejected the message.
+
+    `HekaClient.heka` writes to the stream itself and swallows its
+    errors, so the spool cannot use it.  This is the only code relying
+    on the client's internals (`_flatten_fields`, `encoder` and
+    `filters`, as of heka-py 0.30.3), and `test_spool` checks that it
+    produces the same message as `client.heka`.
+    """
+    msg = Message()
+    msg.timestamp = int(time.time() * 1000000000)
+    msg.type = type
+    msg.logger = logger if logger is not None else client.logger
+    msg.severity = severity if severity is not None else client.severity
+    msg.payload = payload
+    msg.env_version = client.env_version
+    msg.pid = client.pid
+    msg.hostname = client.hostname
+    client._flatten_fields(msg, fields if fields is not None else {})
+    msg.uuid = uuid.uuid5(uuid.NAMESPACE_OID, str(msg)).bytes
+
+    for filter_fn in client.filters:
+        if not filter_fn(msg):
+            return None
+    return client.encoder.encode(msg)
+
+
+class Spool(object):
+    """
+    Append-only, segment rotated store of encoded messages.
+
+    :param path: directory holding the segments, created if needed
+    :param segment_size: size after which a segment is closed
+    :param max_bytes: maximum total size of the segments
+    :param fsync: set to True to fsync every record to disk
+    """
+
+    def __init__(self, path, segment_size=1048576, max_bytes=67108864,
+                 fsync=False):
+        self.root = path
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.counters = {'spooled': 0, 'dropped': 0, 'replayed': 0,
+                         'corrupt': 0}
+        self._file = None
+        self._open(path)
+
+    def _open(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self._lock = threading.Lock()
+        self._file_size = 0
+        segments = self._list()
+        self._size = sum(os.path.getsize(self._segment_path(s))
+                         for s in segments)
+        if segments:
+            self._sequence = self._segment_sequence(segments[-1])
+        else:
+            self._sequence = 0
+
+    def after_fork(self):
+        """
+        Switch to a subdirectory of the spool named after the pid of
+        this, newly forked, process so that it never writes to the
+        segments of another process.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.counters = dict.fromkeys(self.counters, 0)
+        self._open(os.path.join(self.root, str(os.getpid())))
+
+    def adopt_orphans(self):
+        """
+        Move the segments of processes which are no longer running to
+        this spool, so that they get replayed.  Returns the number of
+        segments adopted.
+        """
+        adopted = 0
+        pid = os.getpid()
+        for name in os.listdir(self.root):
+            orphan = os.path.join(self.root, name)
+            if (not name.isdigit() or int(name) == pid or
+                    orphan == self.path or _pid_alive(int(name))):
+                continue
+            for segment in self._list(orphan):
+                src = os.path.join(orphan, segment)
+                self._lock.acquire()
+                try:
+                    self._sequence += 1
+                    dst = self._segment_path(self._segment_name())
+                    try:
+                        size = os.path.getsize(src)
+                        # Another process adopting the same orphan
+                        # loses the race here.
+                        os.rename(src, dst)
+                    except OSError:
+                        continue
+                    self._size += size
+                    adopted += 1
+                finally:
+                    self._lock.release()
+            try:
+                os.rmdir(orphan)
+            except OSError:
+                pass
+        return adopted
+
+    def _segment_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _segment_name(self):
+        return '%s%020d%s' % (SEGMENT_PREFIX, self._sequence, SEGMENT_SUFFIX)
+
+    @staticmethod
+    def _segment_sequence(name):
+        return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def _list(self, path=None):
+        return sorted(name for name in os.listdir(path or self.path)
+                      if name.startswith(SEGMENT_PREFIX) and
+                      name.endswith(SEGMENT_SUFFIX))
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_size = 0
+
+    def append(self, data):
+        """
+        Append an encoded message.  Returns False if it was dropped
+        because the spool is full.
+        """
+        record = HEADER.pack(MAGIC, len(data),
+                             zlib.crc32(data) & 0xffffffff) + data
+        self._lock.acquire()
+        try:
+            if self._size + len(record) > self.max_bytes:
+                self.counters['dropped'] += 1
+                return False
+            if self._file is None:
+                self._sequence += 1
+                self._file = open(self._segment_path(self._segment_name()),
+                                  'ab')
+            self._file.write(record)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file_size += len(record)
+            self._size += len(record)
+            self.counters['spooled'] += 1
+            if self._file_size >= self.segment_size:
+                self._close()
+            return True
+        finally:
+            self._lock.release()
+
+    def rotate(self):
+        """
+        Close the segment being written to, so that every record
+        appended so far is in a closed segment.
+        """
+        self._lock.acquire()
+        try:
+            self._close()
+        finally:
+            self._lock.release()
+
+    def closed_segments(self):
+        """
+        Return the names of the segments which are no longer written
+        to, oldest first.
+        """
+        self._lock.acquire()
+        try:
+            segments = self._list()
+            if self._file is not None:
+                current = os.path.basename(self._file.name)
+                segments = [s for s in segments if s != current]
+            return segments
+        finally:
+            self._lock.release()
+
+    def pending(self):
+        """
+        Return True if the spool holds any records.
+        """
+        return self._size > 0
+
+    def read(self, name, offset=0):
+        """
+        Yield (offset, message) for each record of the segment `name`
+        starting at `offset`.  The offset is the position right after
+        the record.  Reading stops at the first torn or corrupt record.
+        """
+        f = open(self._segment_path(name), 'rb')
+        try:
+            f.seek(offset)
+            while True:
+                header = f.read(HEADER.size)
+                if not header:
+                    return
+                if len(header) < HEADER.size:
+                    self._corrupt(name)
+                    return
+                magic, length, crc = HEADER.unpack(header)
+                data = f.read(length)
+                if (magic != MAGIC or len(data) < length or
+                        zlib.crc32(data) & 0xffffffff != crc):
+                    self._corrupt(name)
+                    return
+                offset += HEADER.size + length
+                yield offset, data
+        finally:
+            f.close()
+
+    def _incr(self, name, count=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] += count
+        finally:
+            self._lock.release()
+
+    def _corrupt(self, name):
+        log.warning("Skipping corrupt records at the end of %s", name)
+        self._incr('corrupt')
+
+    def mark_replayed(self, count):
+        """
+        Count `count` records as sent to the stream.
+        """
+        self._incr('replayed', count)
+
+    def remove(self, name):
+        """
+        Delete the closed segment `name`.
+        """
+        path = self._segment_path(name)
+        size = os.path.getsize(path)
+        os.remove(path)
+        self._lock.acquire()
+        try:
+            self._size -= size
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Return a copy of the spooled/dropped/replayed/corrupt counters.
+        """
+        self._lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self._lock.release()
+
+
+class _Write(object):
+    # A write handed to a `StreamWriter`, abandoned by the caller if
+    # it did not complete in time.
+    __slots__ = ('stream', 'data', 'done', 'error', 'abandoned')
+
+    def __init__(self, stream, data):
+        self.stream = stream
+        self.data = data
+        self.done = threading.Event()
+        self.error = None
+        self.abandoned = False
+
+    def run(self):
+        if self.abandoned:
+            return
+        try:
+            self.stream.write(self.data)
+            self.stream.flush()
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+
+class StreamWriter(object):
+    """
+    Write to heka streams from a daemon thread, started by the first
+    write, so that callers wait at most `timeout` seconds for a stream
+    which blocks.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        """
+        Forget the writing thread, and the pending writes, of the
+        parent process.
+        """
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='heka_raven-writer')
+            self._thread.daemon = True
+            self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            self._queue.get().run()
+
+    def write(self, stream, data):
+        """
+        Write `data` to `stream` and flush it.  Returns False if that
+        did not complete within `timeout` seconds, the write is then
+        skipped unless it already started.  Errors raised by the
+        stream are raised again.
+        """
+        self._start()
+        job = _Write(stream, data)
+        self._queue.put(job)
+        # Event.wait returns None on Python 2.6, check the flag.
+        job.done.wait(self.timeout)
+        if not job.done.is_set():
+            job.abandoned = True
+            return False
+        if job.error is not None:
+            raise job.error
+        return True
+
+
+class SpoolingSender(object):
+    """
+    Send messages to the client's stream, falling back to the spool
+    when the stream raises, or does not accept a message within
+    `send_timeout` seconds.  Once the stream has failed, messages go
+    straight to the spool for `retry_interval` seconds so that callers
+    are not held up by a stream which is down, while a `Replayer`
+    thread retries the stream and drains the spool.
+
+    :param spool: the `Spool` to write to
+    :param retry_interval: number of seconds between attempts to
+                           replay the spool
+    :param send_timeout: optional number of seconds to wait for the
+                         stream.  Messages are then written by a
+                         `StreamWriter` thread.  A message which timed
+                         out is spooled, and is sent twice if the
+                         stream completes the write later.
+    :param stats: optional `heka_raven.stats.Stats` counting messages
+                  dropped because the spool is full as 'spool_dropped'
+    """
+
+    def __init__(self, spool, retry_interval=5.0, send_timeout=None,
+                 stats=None, clock=time.time):
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.stats = stats
+        self.clock = clock
+        self.replayer = Replayer(self, retry_interval)
+        if send_timeout:
+            self.writer = StreamWriter(send_timeout)
+        else:
+            self.writer = None
+        self._failed_at = None
+
+    def after_fork(self):
+        """
+        Give this, newly forked, process its own spool directory and
+        replayer, and adopt the segments of processes which exited.
+        """
+        self._failed_at = None
+        self.spool.after_fork()
+        self.replayer.after_fork()
+        if self.writer is not None:
+            self.writer.after_fork()
+        try:
+            self.spool.adopt_orphans()
+        except OSError:
+            log.exception("Error adopting orphaned heka_raven spools")
+
+    def heka(self, client, type, logger=None, severity=None, payload='',
+             fields=None):
+        """
+        Send a message like `client.heka` would.
+        """
+        data = encode_message(client, type, logger, severity, payload,
+                              fields)
+        if data is None:
+            return
+
+        failed_at = self._failed_at
+        if (failed_at is None or
+                self.clock() - failed_at >= self.retry_interval):
+            try:
+                if self.writer is None:
+                    client.stream.write(data)
+                    client.stream.flush()
+                    written = True
+                else:
+                    written = self.writer.write(client.stream, data)
+            except Exception:
+                self._failed_at = self.clock()
+                log.warning("heka stream unavailable, spooling to %s",
+                            self.spool.path, exc_info=True)
+            else:
+                if written:
+                    self._failed_at = None
+                    if self.spool.pending():
+                        # Left over from an earlier failure, or from a
+                        # previous run of the process.
+                        self.replayer.start(client)
+                    return
+                self._failed_at = self.clock()
+                log.warning("heka stream blocked for %s seconds, "
+                            "spooling to %s", self.writer.timeout,
+                            self.spool.path)
+
+        if not self.spool.append(data) and self.stats is not None:
+            self.stats.incr('spool_dropped')
+        self.replayer.start(client)
+
+    def replay(self, client):
+        """
+        Send the spooled records to the client's stream, oldest first.
+        Returns the number of records sent, stops at the first error.
+        """
+        return self.replayer.replay(client)
+
+
+class Replayer(object):
+    """
+    Drain the spool of a `SpoolingSender` every `interval` seconds
+    from a daemon thread, started by the first call to `start`.
+    """
+
+    def __init__(self, sender, interval):
+        self.sender = sender
+        self.interval = interval
+        self._client = None
+        self._thread = None
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+
+    def after_fork(self):
+        """
+        Forget the replaying thread of the parent process, which does
+        not exist in the child.
+        """
+        self._client = None
+        self._thread = None
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+
+    def start(self, client):
+        """
+        Start replaying through `client`, unless already started.
+        """
+        if self._thread is not None:
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is not None:
+                return
+            self._client = client
+            self._thread = threading.Thread(target=self._run,
+                                            name='heka_raven-replayer')
+            self._thread.daemon = True
+            self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if self.sender.spool.pending():
+                try:
+                    self.replay(self._client)
+                except Exception:
+                    log.exception("Error replaying the heka_raven spool")
+
+    def replay(self, client):
+        """
+        Send the records of every closed segment to the client's
+        stream.  Returns the number of records sent.
+        """
+        spool = self.sender.spool
+        stream = client.stream
+        sent = 0
+        self._replay_lock.acquire()
+        try:
+            spool.rotate()
+            for name in spool.closed_segments():
+                offset = self._offsets.get(name, 0)
+                replayed = 0
+                try:
+                    for offset, data in spool.read(name, offset):
+                        stream.write(data)
+                        stream.flush()
+                        replayed += 1
+                        self._offsets[name] = offset
+                except Exception:
+                    self.sender._failed_at = self.sender.clock()
+                    log.warning("heka stream still unavailable, %d spooled "
+                                "messages replayed", sent + replayed)
+                    spool.mark_replayed(replayed)
+                    return sent + replayed
+                spool.mark_replayed(replayed)
+                spool.remove(name)
+                self._offsets.pop(name, None)
+                sent += replayed
+            self.sender._failed_at = None
+            return sent
+        finally:
+            self._replay_lock.release()
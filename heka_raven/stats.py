@@ -0,0 +1,235 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+"""
+Self-instrumentation of the raven plugin.
+
+`Stats` records how long each phase of a capture takes, how large
+payloads are and how many events were captured, suppressed or dropped.
+The phases are:
+
+filter
+    sampling and deduplication
+build_msg
+    walking the stack and building the sentry event
+encode
+    serializing and compressing the event
+send
+    handing the payload to heka (or to the batcher)
+
+The totals are available in process from `Stats.snapshot`, and
+`Stats.report` sends what was recorded since the previous report as
+heka 'timer' and 'counter' messages.
+"""
+
+import logging
+import threading
+import timeit
+
+log = logging.getLogger('heka_raven')
+
+# Highest resolution clock available, time.perf_counter on Python 3.
+clock = timeit.default_timer
+
+
+class Stats(object):
+    """
+    Thread safe timings, sizes and counters.
+
+    :param prefix: prefix of the names of the heka messages sent by
+                   `report`
+    """
+
+    def __init__(self, prefix='heka_raven'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # name -> [count, total, max]
+        self._timers = {}
+        self._sizes = {}
+        self._counters = {}
+        self._reported = ({}, {}, {})
+
+    def after_fork(self):
+        """
+        Start from zero in a child process, what was recorded before
+        the fork is reported by the parent.
+        """
+        self._lock = threading.Lock()
+        self._timers = {}
+        self._sizes = {}
+        self._counters = {}
+        self._reported = ({}, {}, {})
+
+    @staticmethod
+    def _record(values, name, value):
+        entry = values.get(name)
+        if entry is None:
+            values[name] = [1, value, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+            if value > entry[2]:
+                entry[2] = value
+
+    def timing(self, name, seconds):
+        """
+        Record that phase `name` took `seconds`.
+        """
+        self._lock.acquire()
+        try:
+            self._record(self._timers, name, seconds)
+        finally:
+            self._lock.release()
+
+    def size(self, name, size):
+        """
+        Record a payload size, in bytes.
+        """
+        self._lock.acquire()
+        try:
+            self._record(self._sizes, name, size)
+        finally:
+            self._lock.release()
+
+    def incr(self, name, count=1):
+        """
+        Increment the counter called `name`.
+        """
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + count
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Return the totals recorded so far as a dict with 'timers',
+        'sizes' and 'counters' keys.  Timers and sizes are dicts of
+        'count', 'total' and 'max', in milliseconds and bytes.
+        """
+        self._lock.acquire()
+        try:
+            timers, sizes, counters = self._copy()
+        finally:
+            self._lock.release()
+        return {
+            'timers': dict((name, {'count': c, 'total': t * 1000.0,
+                                   'max': m * 1000.0})
+                           for name, (c, t, m) in timers.items()),
+            'sizes': dict((name, {'count': c, 'total': t, 'max': m})
+                          for name, (c, t, m) in sizes.items()),
+            'counters': counters,
+        }
+
+    def _copy(self):
+        return (dict((k, list(v)) for k, v in self._timers.items()),
+                dict((k, list(v)) for k, v in self._sizes.items()),
+                dict(self._counters))
+
+    def report(self, client, logger=None):
+        """
+        Send what was recorded since the previous report through the
+        heka `client`.  Every phase becomes a 'timer' message of its
+        mean duration, with 'count' and 'max' fields.  Counters and
+        the total number of bytes of each size become 'counter'
+        messages.
+        """
+        self._lock.acquire()
+        try:
+            current = self._copy()
+            previous, self._reported = self._reported, current
+        finally:
+            self._lock.release()
+        timers, sizes, counters = current
+        old_timers, old_sizes, old_counters = previous
+
+        prefix = self.prefix
+        for name, (count, total, max_) in sorted(timers.items()):
+            old = old_timers.get(name, (0, 0, 0))
+            count -= old[0]
+            if count <= 0:
+                continue
+            mean = (total - old[1]) * 1000.0 / count
+            client.timer_send('%s.%s' % (prefix, name), mean, logger=logger,
+                              fields={'count': count,
+                                      'max': max_ * 1000.0})
+        for name, (count, total, max_) in sorted(sizes.items()):
+            total -= old_sizes.get(name, (0, 0, 0))[1]
+            if total > 0:
+                client.incr('%s.%s' % (prefix, name), total, logger=logger)
+        for name, count in sorted(counters.items()):
+            count -= old_counters.get(name, 0)
+            if count > 0:
+                client.incr('%s.%s' % (prefix, name), count, logger=logger)
+
+
+class Reporter(object):
+    """
+    Call `stats.report(client)` every `interval` seconds from a daemon
+    thread, started by the first call to `start`.
+    """
+
+    def __init__(self, stats, interval, logger=None):
+        self.stats = stats
+        self.interval = interval
+        self.logger = logger
+        self._client = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def after_fork(self):
+        """
+        Forget the reporting thread of the parent process, which does
+        not exist in the child.  It is started again by `start`.
+        """
+        self._client = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self, client):
+        """
+        Start reporting through `client`, unless already started.
+        """
+        self._lock.acquire()
+        try:
+            if self._thread is not None:
+                return
+            self._client = client
+            self._thread = threading.Thread(target=self._run,
+                                            name='heka_raven-stats')
+            self._thread.daemon = True
+            self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        # Event.wait returns None on Python 2.6, check the flag.
+        stopped = self._stopped
+        while not stopped.is_set():
+            stopped.wait(self.interval)
+            if not stopped.is_set():
+                self.report()
+
+    def report(self):
+        """
+        Send a report now, if reporting was started.
+        """
+        if self._client is None:
+            return
+        try:
+            self.stats.report(self._client, self.logger)
+        except Exception:
+            log.exception("Error reporting heka_raven stats")
+
+    def stop(self):
+        """
+        Stop the reporting thread after a last report.
+        """
+        self._stopped.set()
+        self.report()
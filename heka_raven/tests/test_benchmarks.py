@@ -0,0 +1,40 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+from heka_raven import benchmarks
+from nose.tools import eq_
+import json
+
+
+def test_run():
+    results = benchmarks.run(['capture_stack_success', 'heka_raven_deep'],
+                             scale=0.001, repeat=1)
+    eq_(results['version'], benchmarks.RESULTS_VERSION)
+    eq_(sorted(results['benchmarks']),
+        ['capture_stack_success', 'heka_raven_deep'])
+    result = results['benchmarks']['heka_raven_deep']
+    eq_(result['number'], 1)
+    assert result['min_usec'] <= result['median_usec'] <= result['max_usec']
+    eq_(json.loads(json.dumps(results)), results)
+
+
+def test_null_stream():
+    client = benchmarks.make_client()
+    benchmarks.raven_call(client, 3)()
+    eq_(client.stream.msgs, 1)
+    assert client.stream.bytes > 0
+
+
+def test_compare():
+    def results(**medians):
+        return {'benchmarks': dict((name, {'median_usec': usec})
+                                   for name, usec in medians.items())}
+    baseline = results(a=10.0, b=10.0, c=10.0)
+    current = results(a=11.0, b=13.0, d=50.0)
+    eq_(benchmarks.compare(current, baseline), [('b', 10.0, 13.0)])
+    eq_(benchmarks.compare(current, baseline, threshold=1.05),
+        [('a', 10.0, 11.0), ('b', 10.0, 13.0)])
@@ -0,0 +1,128 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+from heka_raven.client import RavenClient
+from heka_raven.frames import LRUCache
+from heka_raven.frames import SourceCache
+from nose.tools import eq_
+from nose.tools import ok_
+from raven.utils.stacks import get_stack_info
+from raven.utils.stacks import iter_traceback_frames
+import os
+import shutil
+import sys
+import tempfile
+
+
+def raise_error(depth):
+    if depth == 0:
+        raise ValueError('frames')
+    raise_error(depth - 1)
+
+
+class TestLRUCache(object):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.set(key, key.upper())
+        eq_(cache.get('a'), 'A')
+        cache.set('d', 'D')
+        eq_(len(cache), 3)
+        eq_(cache.get('b'), None)
+        eq_([cache.get(k) for k in 'acd'], ['A', 'C', 'D'])
+
+    def test_update(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('a', 3)
+        cache.set('c', 4)
+        eq_(cache.get('a'), 3)
+        eq_(cache.get('b', 'missing'), 'missing')
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        eq_(cache.get('a'), None)
+        eq_(len(cache), 0)
+
+
+class TestSourceCache(object):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'source.py')
+        self.write(['line %d' % i for i in range(10)], 1000000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, lines, mtime):
+        f = open(self.filename, 'w')
+        try:
+            f.write('\n'.join(lines) + '\n')
+        finally:
+            f.close()
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_context(self):
+        cache = SourceCache()
+        eq_(cache.get_lines(self.filename, 1, 2),
+            (['line 0'], 'line 1', ['line 2', 'line 3']))
+        eq_(cache.get_lines(self.filename, 9, 1),
+            (['line 8'], 'line 9', []))
+        eq_(cache.get_lines(self.filename, 42, 1), (None, None, None))
+        eq_(len(cache.files), 1)
+
+    def test_cached_until_modified(self):
+        cache = SourceCache()
+        eq_(cache.get_lines(self.filename, 1, 0)[1], 'line 1')
+
+        self.write(['changed'] * 10, 1000000000)
+        eq_(cache.get_lines(self.filename, 1, 0)[1], 'line 1')
+        self.write(['changed'] * 10, 1000000060)
+        eq_(cache.get_lines(self.filename, 1, 0)[1], 'changed')
+
+        os.remove(self.filename)
+        eq_(cache.get_lines(self.filename, 1, 0)[1], None)
+
+    def test_missing_file(self):
+        cache = SourceCache()
+        eq_(cache.get_lines(os.path.join(self.path, 'missing.py'), 1, 2),
+            (None, None, None))
+
+
+class TestClientFrames(object):
+
+    def get_traceback(self):
+        try:
+            raise_error(3)
+        except ValueError:
+            return sys.exc_info()[2]
+
+    def test_same_as_raven(self):
+        tb = self.get_traceback()
+        rc = RavenClient(include_paths=[__name__])
+        frames = rc.get_stack_info(iter_traceback_frames(tb))
+        # Served from the caches the second time around.
+        eq_(rc.get_stack_info(iter_traceback_frames(tb)), frames)
+        ok_(len(rc.code_cache))
+
+        expected = get_stack_info(iter_traceback_frames(tb),
+                                  transformer=lambda f_locals: None)
+        for frame in frames:
+            eq_(frame.pop('in_app'), True)
+            frame['vars'] = None
+        eq_(frames, expected)
+
+    def test_cache_disabled(self):
+        rc = RavenClient(frame_cache_size=0)
+        frames = rc.get_stack_info(iter_traceback_frames(self.get_traceback()))
+        eq_(frames[-1]['context_line'], "        raise ValueError('frames')")
+        eq_(len(rc.code_cache), 0)
+        ok_('in_app' not in frames[-1])
@@ -0,0 +1,94 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+
+from heka_raven import loadtest
+from nose.tools import assert_raises, eq_
+import json
+import sys
+
+
+def capture_bytes(count):
+    config = loadtest.client_config('memory')
+    data = []
+
+    class Stream(object):
+        def write(self, chunk):
+            data.append(chunk)
+
+        def flush(self):
+            pass
+
+    loadtest.drive(config, count, stream=Stream())
+    return data
+
+
+def test_listener_is_abstract():
+    assert_raises(TypeError, loadtest.Listener, loadtest.SentrySink())
+
+
+def test_stream_decoder():
+    records = capture_bytes(2)
+    stream = b'junk' + records[0] + records[1]
+    decoder = loadtest.StreamDecoder()
+    messages = []
+    for i in range(0, len(stream), 7):
+        messages.extend(decoder.feed(stream[i:i + 7]))
+    eq_(len(messages), 2)
+    eq_(decoder.skipped, 4)
+    header, msg = messages[0]
+    eq_(msg.type, 'sentry')
+    eq_(header.message_length, len(msg.SerializeToString()))
+
+
+def test_sink_decodes_events():
+    sink = loadtest.SentrySink(keep=True)
+    for chunk in capture_bytes(3):
+        sink.receive(chunk)
+    stats = sink.stats()
+    eq_(stats['messages'], 3)
+    eq_(stats['events'], 3)
+    eq_(stats['errors'], 0)
+    eq_(sink.events[0]['sentry.interfaces.Exception']['value'], 'loadtest')
+    eq_(sink.wait(3, timeout=0), True)
+    eq_(sink.wait(4, timeout=0.01), False)
+
+
+def check_run(transport, **kwargs):
+    result = loadtest.run(events=20, threads=2, transport=transport,
+                          timeout=5, **kwargs)
+    eq_(result['errors'], 0)
+    eq_(result['received']['events'], 20)
+    assert result['received']['bytes'] > 0
+    assert result['p50_usec'] <= result['p99_usec'] <= result['max_usec']
+    eq_(json.loads(json.dumps(result)), result)
+    return result
+
+
+def test_run_memory():
+    result = check_run('memory', mode='capture_stack')
+    eq_(result['received']['messages'], 20)
+
+
+def test_run_udp():
+    check_run('udp')
+
+
+def test_run_tcp():
+    check_run('tcp')
+
+
+def test_run_batched():
+    result = check_run('udp', batch=True, batch_size=10)
+    eq_(result['received']['messages'], 2)
+
+
+def test_run_processes():
+    if sys.platform == 'win32':
+        return
+    result = check_run('tcp', processes=2)
+    eq_(result['processes'], 2)
+    assert_raises(ValueError, loadtest.run, processes=2, transport='memory')
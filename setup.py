@@ -22,9 +22,13 @@ install_requires = ['heka-py>=0.30.3', ]
 # Version 5.1-5.4 of Sentry
 protocol_v3 = ['raven<3.5']
 
-# We don't support Sentry 6 set
+# Newer Sentry versions need no extra, `builder = native` and
+# `protocol = v4` work without raven.
 # See bug https://github.com/mozilla-services/heka-py-raven/issues/2
-# protocol_v4 = ['raven>=3.5']
+
+# Optional faster JSON serialization for the 'fast' and 'json'
+# payload encodings
+fast_json = ['ujson']
 
 setup(name='heka-py-raven',
       version=version,
@@ -42,7 +46,7 @@ setup(name='heka-py-raven',
       zip_safe=False,
       extras_require={
           'protocol_v3': install_requires + protocol_v3,
-          #'protocol_v4': install_requires + protocol_v4,
+          'fast_json': install_requires + fast_json,
           },
       install_requires=install_requires,
       )